@@ -1,65 +1,273 @@
 # -*- coding: utf-8 -*-
+import glob
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from logging import getLogger
 from numbers import Number
+from operator import itemgetter
 import xlsxwriter
 import xlrd
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     basestring
 except NameError:
     basestring = str
 
+logger = getLogger(__name__)
+
+WORKBOOK_CACHE_SIZE = 8  # open_workbook 最多缓存的 workbook 数
+_WORKBOOKS = OrderedDict()
+_WORKBOOK_LOCK = threading.Lock()
+
+
+def open_workbook(file_path, cache=True):
+    """
+    打开 xls 文件，sheet 按需加载（on_demand）；
+    cache 为 True 时按 (路径, 修改时间, 大小) 缓存 workbook，同一文件的多次读取只解析一次，文件变化后自动重新打开
+    缓存的 workbook 在线程间共享，xlrd 按需加载 sheet 不是线程安全的：多线程时请通过 get_sheets_from_file 取 sheet
+    （加载时持有该 workbook 的锁），不要在多个线程中直接调用返回的 workbook 的 sheet_by_index/sheet_by_name
+    """
+    if not cache:
+        return xlrd.open_workbook(file_path, on_demand=True)
+    return _cached_workbook(file_path).workbook
+
+
+class _CachedWorkbook(object):
+    """缓存中的 workbook 及其锁，加载 sheet 和释放资源都在锁内进行"""
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.lock = threading.Lock()
+        self.released = False
+
+    def release(self):
+        with self.lock:  # 等待正在进行的 sheet 加载结束
+            self.released = True
+            self.workbook.release_resources()  # 已加载的 sheet 仍然可用
+
+
+def _cached_workbook(file_path):
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+    with _WORKBOOK_LOCK:
+        entry = _WORKBOOKS.get(key)
+        if entry is not None:
+            _WORKBOOKS.move_to_end(key)
+            return entry
+    entry = _CachedWorkbook(xlrd.open_workbook(file_path, on_demand=True))
+    evicted = []
+    with _WORKBOOK_LOCK:
+        if key in _WORKBOOKS:  # 其他线程同时打开了同一个文件
+            evicted.append(entry)
+            entry = _WORKBOOKS[key]
+        else:
+            _WORKBOOKS[key] = entry
+            while len(_WORKBOOKS) > WORKBOOK_CACHE_SIZE:
+                evicted.append(_WORKBOOKS.popitem(last=False)[1])
+    for old in evicted:
+        old.release()
+    return entry
+
+
+def clear_workbook_cache():
+    with _WORKBOOK_LOCK:
+        entries = list(_WORKBOOKS.values())
+        _WORKBOOKS.clear()
+    for entry in entries:
+        entry.release()
+
 
 def get_sheets_from_file(directory, sheet_idx=None, sheet_name=None):
-    """both idx and name could be a list, then a list of sheets will be returned."""
+    """both idx and name could be a list, then a list of sheets will be returned.
+    文件只打开一次（见 open_workbook），只加载请求的 sheet；都不指定时返回全部 sheet。可以在多个线程中调用"""
+    while True:
+        entry = _cached_workbook(directory)
+        with entry.lock:
+            if not entry.released:  # 取到后、加锁前被淘汰时重新打开
+                return _select_sheets(entry.workbook, sheet_idx, sheet_name)
+
+
+def _select_sheets(workbook, sheet_idx, sheet_name):
     if sheet_idx is not None:
         if isinstance(sheet_idx, int):
-            return xlrd.open_workbook(directory).sheet_by_index(sheet_idx)
+            return workbook.sheet_by_index(sheet_idx)
         elif isinstance(sheet_idx, list):
-            return [xlrd.open_workbook(directory).sheet_by_index(idx) for idx in sheet_idx]
+            return [workbook.sheet_by_index(idx) for idx in sheet_idx]
         else:
             raise TypeError('invalid sheet_idx: %s' % sheet_idx)
     elif sheet_name is not None:
-        if isinstance(sheet_idx, basestring):
-            return xlrd.open_workbook(directory).sheet_by_name(sheet_name)
-        elif isinstance(sheet_idx, list):
-            return [xlrd.open_workbook(directory).sheet_by_name(name) for name in sheet_name]
+        if isinstance(sheet_name, basestring):
+            return workbook.sheet_by_name(sheet_name)
+        elif isinstance(sheet_name, list):
+            return [workbook.sheet_by_name(name) for name in sheet_name]
         else:
             raise TypeError('invalid sheet_name: %s' % sheet_name)
     else:
-        workbook = xlrd.open_workbook(directory)
-        return get_sheets_from_file(directory, list(range(workbook.nsheets)))
+        return [workbook.sheet_by_index(idx) for idx in range(workbook.nsheets)]
 
 
-def get_subframe(sheet, col_idxs, row_offset, row_limit=None):
+def get_subframe(sheet, col_idxs, row_offset, row_limit=None, output='rows'):
     """get sub dataframe from sheet
     return value is like:
     [[1, 2, 3],
      [8, 9, 0]]
+    output 为 'columns' 时按列返回（每列一个 list，顺序同 col_idxs），
+    为 'numpy' 时返回二维 numpy.ndarray（需要安装 NumPy，列中有非数字时 dtype 为 object）
+    按行/列整段读取（row_values/col_values），不逐个访问单元格
     """
-    df = []
-    row_range = row_offset + row_limit if row_limit else sheet.nrows
-    for i in range(row_offset, row_range):
-        df.append([sheet.cell(i, j).value for j in col_idxs])
+    row_end = min(row_offset + row_limit, sheet.nrows) if row_limit else sheet.nrows
+    if output == 'columns':
+        return [sheet.col_values(j, row_offset, row_end) for j in col_idxs]
+    elif output not in ('rows', 'numpy'):
+        raise ValueError('invalid output: %s' % output)
+    col_idxs = list(col_idxs)
+    if not col_idxs:
+        df = [[] for _ in range(row_offset, row_end)]
+    elif 0 <= col_idxs[0] and col_idxs[-1] < sheet.ncols and \
+            col_idxs == list(range(col_idxs[0], col_idxs[-1] + 1)):  # 范围内连续的列直接切片读取
+        start, end = col_idxs[0], col_idxs[-1] + 1
+        df = [sheet.row_values(i, start, end) for i in range(row_offset, row_end)]
+    else:
+        getter = itemgetter(*col_idxs)
+        if len(col_idxs) == 1:
+            df = [[getter(sheet.row_values(i))] for i in range(row_offset, row_end)]
+        else:
+            df = [list(getter(sheet.row_values(i))) for i in range(row_offset, row_end)]
+    if output == 'numpy':
+        if numpy is None:
+            raise ImportError('output="numpy" requires NumPy')
+        values = numpy.array(df)
+        if values.dtype.kind not in 'biufc':  # 混合类型时保持原值，不转成字符串
+            values = numpy.empty((len(df), len(col_idxs)), dtype=object)
+            values[:] = df
+        return values
     return df
 
 
-def write_excel(file_path, sheets={}):
+def list_excel_files(source, extensions=('.xls',)):
+    """source 为目录时返回其中扩展名匹配的文件（不递归），否则作为文件路径或 glob 模式，结果按路径排序"""
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(extensions) and os.path.isfile(os.path.join(source, name)))
+    return sorted(glob.glob(source))
+
+
+class BulkExcelReader(object):
+    """在进程池中并行解析一批 xls 文件，合并成一个 (文件路径, sheet 名, 行) 的流
+
+    - source 是目录或 glob 模式（见 list_excel_files），sheet_idx/sheet_name 同 get_sheets_from_file，
+      col_idxs/row_offset/row_limit 同 get_subframe，col_idxs 为 None 时取全部列
+    - 单个文件解析失败不会中断整批，失败的文件记录在 errors 中：[(文件路径, 错误信息)]
+    - ordered 为 True 时按文件路径顺序输出，否则按解析完成的先后输出
+    - processes 为 1 时在当前进程中顺序解析，便于调试
+    """
+
+    def __init__(self, source, sheet_idx=None, sheet_name=None, col_idxs=None, row_offset=0, row_limit=None,
+                 processes=None, ordered=True):
+        self.files = list_excel_files(source)
+        self.sheet_idx = sheet_idx
+        self.sheet_name = sheet_name
+        self.col_idxs = col_idxs
+        self.row_offset = row_offset
+        self.row_limit = row_limit
+        self.processes = processes
+        self.ordered = ordered
+        self.errors = []
+
+    def __iter__(self):
+        self.errors = []
+        for file_path, sheets, error in self._run():
+            if error is not None:
+                logger.warning('failed to read %s: %s', file_path, error)
+                self.errors.append((file_path, error))
+                continue
+            for sheet_name, rows in sheets:
+                for row in rows:
+                    yield file_path, sheet_name, row
+
+    def _run(self):
+        tasks = [(file_path, self.sheet_idx, self.sheet_name, self.col_idxs, self.row_offset, self.row_limit)
+                 for file_path in self.files]
+        if not tasks:
+            return
+        if self.processes == 1:
+            for task in tasks:
+                yield _read_workbook(task)
+            return
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.imap(_read_workbook, tasks) if self.ordered else pool.imap_unordered(_read_workbook, tasks)
+            for result in results:
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+
+
+def _read_workbook(task):
+    """子进程中解析单个文件，异常转成字符串返回（异常对象不一定能 pickle）"""
+    file_path, sheet_idx, sheet_name, col_idxs, row_offset, row_limit = task
+    try:
+        workbook = open_workbook(file_path, cache=False)
+        try:
+            if sheet_idx is not None:
+                idxs = sheet_idx if isinstance(sheet_idx, list) else [sheet_idx]
+                sheets = [workbook.sheet_by_index(idx) for idx in idxs]
+            elif sheet_name is not None:
+                names = sheet_name if isinstance(sheet_name, list) else [sheet_name]
+                sheets = [workbook.sheet_by_name(name) for name in names]
+            else:
+                sheets = [workbook.sheet_by_index(idx) for idx in range(workbook.nsheets)]
+            return file_path, [(sheet.name, get_subframe(sheet, range(sheet.ncols) if col_idxs is None else col_idxs,
+                                                         row_offset, row_limit))
+                               for sheet in sheets], None
+        finally:
+            workbook.release_resources()
+    except Exception as e:
+        return file_path, None, '%s: %s' % (type(e).__name__, e)
+
+
+def write_excel(file_path, sheets={}, constant_memory=True):
     """sheets is like:
     {
         'sheet1':[[1, 2, 3],
                   [8, 9, 0]],
         'sheet2':[[]],...
     }
+    也可以是 (sheet 名, rows) 的列表；rows 可以是任意可迭代对象（如 generator、数据库游标），逐行写出不整体加载
+    constant_memory 为 True 时使用 xlsxwriter 的 constant_memory 模式，每写完一行即刷到磁盘，内存占用与行数无关
+    数字原样写入（不再截断为整数），字符串写为文本，其他值留空
     """
-    workbook = xlsxwriter.Workbook(file_path)
-    for name, data in sheets.items():
-        worksheet = workbook.add_worksheet(name=name)
-        for i in range(len(data)):
-            for j in range(len(data[i])):
-                if isinstance(data[i][j], Number):
-                    worksheet.write_number(i, j, int(data[i][j]))
-                elif isinstance(data[i][j], basestring):
-                    worksheet.write_string(i, j, data[i][j])
-                else:
-                    worksheet.write_blank(i, j, data[i][j])
-    workbook.close()
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': constant_memory})
+    try:
+        for name, rows in (sheets.items() if isinstance(sheets, dict) else sheets):
+            worksheet = workbook.add_worksheet(name=name)
+            plan = []  # 每列上一次遇到的 (值类型, 写入方法)，类型不变时不再重复判断
+            for i, row in enumerate(rows):
+                for j, value in enumerate(row):
+                    if j == len(plan):
+                        plan.append((None, None))
+                    cls, write = plan[j]
+                    if type(value) is not cls:
+                        cls = type(value)
+                        write = _cell_writer(worksheet, value)
+                        plan[j] = (cls, write)
+                    if write is not None:
+                        write(i, j, value)
+    finally:
+        workbook.close()
+
+
+def _cell_writer(worksheet, value):
+    if isinstance(value, Number):
+        return worksheet.write_number
+    elif isinstance(value, basestring):
+        return worksheet.write_string
+    return None  # 空白单元格没有格式时 xlsxwriter 本来就不写入
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+import calendar
+import datetime
+import gzip
+import json
 import time
 import os
+import re
+import shutil
+import threading
 import logging
 from logging.handlers import BaseRotatingHandler
 from gunicorn.glogging import Logger as GLogger
@@ -11,6 +18,16 @@ try:
 except ImportError:
     codecs = None
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     basestring
 except NameError:
@@ -20,29 +37,94 @@ except NameError:
 class MultiProcessSafeDailyRotatingFileHandler(BaseRotatingHandler):
     """Similar with `logging.TimedRotatingFileHandler`, while this one is
     - Multi process safe
-    - Rotate at midnight only
-    - Utc not supported
+    - Rotate at midnight by default, or every `interval` hours/minutes with `when='H'`/`when='M'`
+    - Optionally roll over to `<name>.<suffix>.1`, `.2`, ... once the file reaches `max_bytes`
+      (a soft cap: the size is checked with fstat at most once per second)
+    - Optionally gzip (`compress=True`) and prune (`backup_count`) rotated files in a background
+      thread, `compress_delay` seconds after a rollover so that every process has left the old file
+
+    The next rollover time is precomputed, so `shouldRollover` is one float comparison per record.
     """
-    def __init__(self, filename, encoding=None, delay=False, utc=False, **kwargs):
+    SUFFIXES = {'D': '%Y-%m-%d', 'H': '%Y-%m-%d_%H', 'M': '%Y-%m-%d_%H-%M'}
+
+    def __init__(self, filename, encoding=None, delay=False, utc=False, when='D', interval=1,
+                 max_bytes=0, backup_count=0, compress=False, compress_delay=60, **kwargs):
         self.utc = utc
-        self.suffix = "%Y-%m-%d"
+        self.when = when.upper()
+        if self.when not in self.SUFFIXES:
+            raise ValueError('Invalid `when`: %s' % when)
+        self.interval = interval
+        self.suffix = self.SUFFIXES[self.when]
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.compress_delay = compress_delay
         self.baseFilename = filename
+        self._compute_rollover(time.time())
+        self._next_size_check = 0
         self.currentFileName = self._compute_fn()
+        self._maintenance_event = None
+        self._maintenance_pid = None
         BaseRotatingHandler.__init__(self, filename, 'a', encoding, delay)
+        self._trigger_maintenance()
 
     def shouldRollover(self, record):
-        if self.currentFileName != self._compute_fn():
+        if record.created >= self.rolloverAt:
             return True
+        if self.max_bytes and record.created >= self._next_size_check:
+            self._next_size_check = record.created + 1
+            return self._current_size() >= self.max_bytes
         return False
 
     def doRollover(self):
         if self.stream:
             self.stream.close()
             self.stream = None
+        now = time.time()
+        if now >= self.rolloverAt:
+            self._compute_rollover(now)
+        self._next_size_check = now + 1
         self.currentFileName = self._compute_fn()
+        self._trigger_maintenance()
+
+    def _compute_rollover(self, now):
+        """计算当前周期的起点(用于文件名)和下一次切分的时间戳"""
+        dt = datetime.datetime.utcfromtimestamp(now) if self.utc else datetime.datetime.fromtimestamp(now)
+        midnight = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.when == 'D':
+            start = midnight - datetime.timedelta(days=midnight.toordinal() % self.interval)
+            end = start + datetime.timedelta(days=self.interval)
+        else:
+            unit = 3600 if self.when == 'H' else 60
+            elapsed = (dt - midnight).seconds // unit
+            start = midnight + datetime.timedelta(seconds=(elapsed - elapsed % self.interval) * unit)
+            end = min(start + datetime.timedelta(seconds=self.interval * unit),
+                      midnight + datetime.timedelta(days=1))  # 周期不跨天，每天从零点重新对齐
+        self.periodStart = start
+        if self.utc:
+            self.rolloverAt = calendar.timegm(end.timetuple())
+        else:
+            self.rolloverAt = time.mktime(end.timetuple())
 
     def _compute_fn(self):
-        return self.baseFilename + "." + time.strftime(self.suffix, time.localtime())
+        fn = self.baseFilename + "." + self.periodStart.strftime(self.suffix)
+        if not self.max_bytes:
+            return fn
+        # 按大小切分时，取第一个未写满的序号，各进程独立计算也会得到同一个文件
+        index, candidate = 0, fn
+        while os.path.exists(candidate + '.gz') or (os.path.exists(candidate) and
+                                                     os.path.getsize(candidate) >= self.max_bytes):
+            index += 1
+            candidate = '%s.%d' % (fn, index)
+        return candidate
+
+    def _current_size(self):
+        try:
+            if self.stream is not None:
+                return os.fstat(self.stream.fileno()).st_size
+            return os.path.getsize(self.currentFileName)
+        except (OSError, ValueError):
+            return 0
 
     def _open(self):
         if self.encoding is None:
@@ -61,14 +143,271 @@ class MultiProcessSafeDailyRotatingFileHandler(BaseRotatingHandler):
             pass
         return stream
 
+    def _trigger_maintenance(self):
+        if not (self.compress or self.backup_count):
+            return
+        if self._maintenance_pid != os.getpid():  # 线程不会随 fork 复制到子进程
+            self._maintenance_pid = os.getpid()
+            self._maintenance_event = threading.Event()
+            thread = threading.Thread(target=self._maintenance_loop, args=(self._maintenance_event,),
+                                      name='log-maintenance')
+            thread.daemon = True
+            thread.start()
+        self._maintenance_event.set()
+
+    def _maintenance_loop(self, event):
+        while True:
+            event.wait()
+            event.clear()
+            time.sleep(self.compress_delay)
+            try:
+                self._do_maintenance()
+            except Exception:
+                pass
+
+    def rotated_files(self):
+        """按时间先后返回所有切分出的文件(包括 .gz)"""
+        directory, name = os.path.split(os.path.abspath(self.baseFilename))
+        pattern = re.compile(re.escape(name) + r'\.(\d[\d_-]*)(?:\.(\d+))?(\.gz)?$')
+        found = []
+        for fn in os.listdir(directory):
+            match = pattern.match(fn)
+            if match:
+                found.append(((match.group(1), int(match.group(2) or 0)), os.path.join(directory, fn)))
+        return [path for _, path in sorted(found)]
+
+    def _do_maintenance(self):
+        current = os.path.abspath(self.currentFileName)
+        if self.compress:
+            cutoff = time.time() - self.compress_delay
+            for path in self.rotated_files():
+                if path != current and not path.endswith('.gz') and os.path.getmtime(path) < cutoff:
+                    self._gzip(path)
+        if self.backup_count:
+            backups = [path for path in self.rotated_files() if path != current]
+            for path in backups[:-self.backup_count]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _gzip(self, path):
+        with open(path + '.gz.lock', 'a') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):  # 其他进程正在压缩
+                    return
+            try:
+                if not os.path.exists(path):
+                    return
+                tmp_path = '%s.gz.%d.tmp' % (path, os.getpid())
+                with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.rename(tmp_path, path + '.gz')
+                os.remove(path)
+            finally:
+                try:
+                    os.remove(path + '.gz.lock')
+                except OSError:
+                    pass
+
+
+def _nullable(encode):
+    """logProcesses/logThreads/logMultiprocessing 等关闭时对应属性为 None，编码为 null"""
+    def encode_nullable(value):
+        return 'null' if value is None else encode(value)
+    return encode_nullable
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志格式化为一行 JSON，便于 scan_log.JsonFilter 直接按字段过滤，无需正则和 strptime
+
+    fields 为 (输出的键, LogRecord 属性) 或属性名的列表，'message' 为 record.getMessage()；
+    time_field 为 record.created（epoch 秒）输出的键，总是排在第一个，扫描时可以不解析整行就取到时间。
+    每个字段的编码函数在初始化时就确定，格式化时只做字符串拼接
+    eg: {"ts":1262311810.555,"level":"INFO","logger":"app","msg":"hello"}
+    """
+    DEFAULT_FIELDS = (('level', 'levelname'), ('logger', 'name'), ('msg', 'message'))
+    _STR_ATTRS = frozenset(['levelname', 'name', 'message', 'module', 'funcName', 'pathname',
+                            'filename', 'threadName', 'processName'])
+    _NUMBER_ATTRS = frozenset(['created', 'msecs', 'relativeCreated', 'levelno', 'lineno', 'process', 'thread'])
+
+    def __init__(self, fields=DEFAULT_FIELDS, time_field='ts', ensure_ascii=False):
+        logging.Formatter.__init__(self)
+        encode_str = json.encoder.encode_basestring_ascii if ensure_ascii else json.encoder.encode_basestring
+        dumps = json.JSONEncoder(ensure_ascii=ensure_ascii, separators=(',', ':'), default=str).encode
+        self._fields = []
+        for field in fields:
+            key, attr = (field, field) if isinstance(field, basestring) else field
+            if attr in self._STR_ATTRS:
+                encode = _nullable(encode_str)
+            elif attr in self._NUMBER_ATTRS:
+                encode = _nullable(repr)
+            else:
+                encode = dumps
+            self._fields.append((',' + encode_str(key) + ':', attr, encode))
+        self._head = '{' + encode_str(time_field) + ':'
+        self._exc_key = ',' + encode_str('exc') + ':'
+        self._encode_str = encode_str
+        self._uses_message = any(attr == 'message' for _, attr, _ in self._fields)
+
+    def format(self, record):
+        if self._uses_message:
+            record.message = record.getMessage()
+        parts = [self._head, repr(record.created)]
+        for key, attr, encode in self._fields:
+            parts.append(key)
+            parts.append(encode(getattr(record, attr, None)))
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            parts.append(self._exc_key)
+            parts.append(self._encode_str(record.exc_text))
+        parts.append('}')
+        return ''.join(parts)
+
+
+class QueuedHandler(logging.Handler):
+    """把日志记录放入有界的内存队列，由一个后台线程格式化后批量写入 target handler，
+    请求线程中不再有磁盘 IO
+
+    - overflow 为队列满时的策略: 'block' 等待；'drop' 丢弃；'sample' 每 sample_rate 条中等待写入 1 条，其余丢弃。
+      丢弃的条数记录在 self.dropped
+    - target 为 StreamHandler/FileHandler 时一批记录只 write + flush 一次，并照常处理 BaseRotatingHandler 的切分；
+      其他 handler 逐条调用 target.handle
+    - close() 会写完队列中剩余的记录，logging.shutdown()（进程正常退出时）会调用它
+    - gevent worker 打过 monkey patch 后，后台线程和队列自动变成 greenlet 版本
+    - 记录在后台才被格式化，logging 调用的参数在调用之后不应再被修改
+    """
+
+    def __init__(self, target, queue_size=10000, overflow='block', sample_rate=10, batch_size=512):
+        logging.Handler.__init__(self)
+        if overflow not in ('block', 'drop', 'sample'):
+            raise ValueError('Invalid `overflow`: %s' % overflow)
+        self.target = target
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._overflowed = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        if self._pid != os.getpid():  # 首次使用，或 fork 之后（线程不会复制到子进程）
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == 'block':
+                self._queue.put(record)
+            elif self.overflow == 'sample' and self._overflowed % self.sample_rate == 0:
+                self._overflowed += 1
+                self._queue.put(record)
+            else:
+                self._overflowed += 1
+                self.dropped += 1
+
+    def flush(self):
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._pid = None
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _start(self):
+        self.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.queue_size)
+                self._thread = threading.Thread(target=self._writer, args=(self._queue,), name='log-writer')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+        finally:
+            self.release()
+
+    def _writer(self, q):
+        while True:
+            records = [q.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            try:
+                self._write([r for r in records if r is not None])
+            finally:
+                for _ in records:
+                    q.task_done()
+            if stop:
+                return
+
+    def _write(self, records):
+        target = self.target
+        if not isinstance(target, logging.StreamHandler):
+            for record in records:
+                target.handle(record)
+            return
+        rotating = isinstance(target, BaseRotatingHandler)
+        parts = []
+        target.acquire()
+        try:
+            for record in records:
+                if record.levelno < target.level or not target.filter(record):
+                    continue
+                try:
+                    if rotating and target.shouldRollover(record):
+                        self._write_parts(parts)
+                        target.doRollover()
+                    parts.append(target.format(record) + getattr(target, 'terminator', '\n'))
+                except Exception:
+                    target.handleError(record)
+            self._write_parts(parts)
+        except Exception:
+            target.handleError(records[-1])
+        finally:
+            target.release()
+
+    def _write_parts(self, parts):
+        if not parts:
+            return
+        target = self.target
+        if target.stream is None:
+            target.stream = target._open()
+        target.stream.write(''.join(parts))
+        target.flush()
+        del parts[:]
+
 
 class RotatingGLogger(GLogger):
-    """将 Gunicorn 的默认 Logger 使用的 Handler 从 FileHandler 改为其他"""
+    """将 Gunicorn 的默认 Logger 使用的 Handler 从 FileHandler 改为其他
+    queue_size 不为 0 时，文件 handler 包装在 QueuedHandler 中，由后台线程写入
+    """
+    queue_size = 0
+    queue_overflow = 'block'
+
     def _set_handler(self, log, output, fmt, stream=None):
         # remove previous gunicorn log handler
         h = self._get_gunicorn_handler(log)
         if h:
             log.handlers.remove(h)
+            if isinstance(h, QueuedHandler):
+                h.close()
 
         if output is not None:
             if output == "-":
@@ -83,23 +422,127 @@ class RotatingGLogger(GLogger):
                     # it's probably OK there, we assume the user has given
                     # /dev/null as a parameter.
                     pass
+                if self.queue_size:
+                    h = QueuedHandler(h, self.queue_size, self.queue_overflow)
 
             h.setFormatter(fmt)
             h._gunicorn = True
             log.addHandler(h)
 
 
+class QueuedRotatingGLogger(RotatingGLogger):
+    """RotatingGLogger 的非阻塞版本，可直接用作 gunicorn 的 logger_class"""
+    queue_size = 10000
+
+
 class SingleLevel(logging.Filter):
     def __init__(self, level):
-        if isinstance(level, int):
-            self.allow = level
-        elif isinstance(level, basestring):
-            self.allow = getattr(logging, level)
-        else:
-            raise ValueError('Invalid `level` type.')
+        self.allow = _level_no(level)
 
     def filter(self, record):
         if record.levelno == self.allow:
             return True
         else:
             return False
+
+
+class LevelRouterHandler(logging.Handler):
+    """按日志级别把记录分发到各自的文件，代替每个级别一个 handler + SingleLevel 的做法：
+    每条记录只经过一次字典查找，文件在该级别第一次出现时才打开
+
+    - filename 中的 %(level)s 会被替换为小写的级别名，如 'app.%(level)s.log'
+    - 其余参数（when/max_bytes/compress 等）传给每个级别的 MultiProcessSafeDailyRotatingFileHandler
+    - levels 之外的级别写入不高于它的最近一个级别的文件，比它们都低时丢弃
+    - sample_every={'DEBUG': 10} 表示该级别每 10 条只保留 1 条；
+      rate_limit={'INFO': 1000} 表示该级别每秒最多写入 1000 条，超出的丢弃；丢弃条数按级别记录在 self.dropped。
+      两者都按记录自身的级别计算，与记录被路由到哪个文件无关（如 WARNING 写入 INFO 文件时不受 INFO 的采样影响）
+    """
+
+    def __init__(self, filename, levels=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+                 sample_every=None, rate_limit=None, **handler_kwargs):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.handler_kwargs = handler_kwargs
+        self.levels = sorted(_level_no(level) for level in levels)
+        self.sample_every = dict((_level_no(k), v) for k, v in (sample_every or {}).items())
+        self.rate_limit = dict((_level_no(k), v) for k, v in (rate_limit or {}).items())
+        self.dropped = dict((level, 0) for level in set(self.levels) | set(self.sample_every) | set(self.rate_limit))
+        self._routes = {}  # levelno -> (路由到的级别, sink)
+        self._counters = dict((level, 0) for level in self.sample_every)
+        self._windows = dict((level, (0, 0)) for level in self.rate_limit)  # level -> (秒, 该秒内条数)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        for _, sink in self._routes.values():
+            if sink is not None:
+                sink.setFormatter(fmt)
+
+    def emit(self, record):
+        route = self._routes.get(record.levelno)
+        if route is None:
+            route = self._route(record.levelno)
+        sink = route[1]
+        if sink is None:
+            return
+        level = record.levelno
+        if level in self.sample_every:
+            self._counters[level] += 1
+            if self._counters[level] % self.sample_every[level] != 1 % self.sample_every[level]:
+                self.dropped[level] += 1
+                return
+        if level in self.rate_limit:
+            second, count = self._windows[level]
+            now = int(record.created)
+            if now != second:
+                second, count = now, 0
+            if count >= self.rate_limit[level]:
+                self.dropped[level] += 1
+                return
+            self._windows[level] = (second, count + 1)
+        sink.handle(record)
+
+    def flush(self):
+        for _, sink in self._routes.values():
+            if sink is not None:
+                sink.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            for _, sink in self._routes.values():
+                if sink is not None:
+                    sink.close()
+            self._routes = {}
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+    def _route(self, levelno):
+        lower = [level for level in self.levels if level <= levelno]
+        if not lower:
+            route = (None, None)
+        else:
+            level = lower[-1]
+            sink = None
+            for routed_level, routed_sink in self._routes.values():  # 多个 levelno 可能共用一个文件
+                if routed_level == level:
+                    sink = routed_sink
+                    break
+            if sink is None:
+                filename = self.filename % {'level': logging.getLevelName(level).lower()}
+                kwargs = dict(self.handler_kwargs, delay=True)
+                sink = MultiProcessSafeDailyRotatingFileHandler(filename, **kwargs)
+                if self.formatter is not None:
+                    sink.setFormatter(self.formatter)
+            route = (level, sink)
+        self._routes[levelno] = route
+        return route
+
+
+def _level_no(level):
+    if isinstance(level, int):
+        return level
+    elif isinstance(level, basestring):
+        return getattr(logging, level)
+    else:
+        raise ValueError('Invalid `level` type.')
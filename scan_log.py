@@ -8,16 +8,43 @@
 # - Processor: 负责处理 Filter 返回的数据
 #
 # 基本流程就是 map(Processor, Filter(Scanner(file_path, offset)))
+# 需要批量写入时，可以用 BatchProcessor(handler).run(Filter(scanner), scanner) 代替 map
 #
 # 考虑到通常扫描日志会是一个增量定时任务，还提供了一对函数:
 # - set_offset_record: 用于记录文件扫描的偏移量(字节)
 # - get_offset_record: 用于读取文件扫描的偏移量(字节)
+import bisect
 import datetime
+import functools
+import gzip
 import json
+import multiprocessing
+import operator
 import os
 import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import reduce
 from logging import getLogger
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
 logger = getLogger('scan_log')
 
 
@@ -41,41 +68,312 @@ class LogScanner(object):
                     break
 
     def _unread_line(self, line):
-        self.file.seek(-len(line.encode()), 1)
+        self.file.seek(self.offset_bytes - len(line.encode()), 0)  # 文本模式不支持相对当前位置的 seek
         self._refresh_offset()
 
     def _refresh_offset(self):
         self.offset_bytes = self.file.tell()
 
 
+class BlockLogScanner(LogScanner):
+    """以二进制模式分块读取文件，自行切分行，并用累加的方式维护 offset_bytes，
+    避免文本模式下每行一次 tell() 的开销。
+
+    offset_bytes 与 LogScanner 完全一致（均为原始字节偏移），可以直接复用已有的偏移量记录。
+    decode=False 时直接迭代返回 bytes 行，由调用方按需解码。
+    end_bytes 不为 None 时，只返回起始位置在 end_bytes 之前的行。
+    skip_partial=True 时不返回文件末尾没有换行符的半行（追踪正在写入的文件时使用）。
+    """
+
+    def __init__(self, file_path, offset_bytes=0, block_size=1024 * 1024,
+                 encoding='utf-8', errors='strict', decode=True, end_bytes=None, skip_partial=False):
+        super(BlockLogScanner, self).__init__(file_path, offset_bytes)
+        self.end_bytes = end_bytes
+        self.skip_partial = skip_partial
+        self.block_size = block_size
+        self.encoding = encoding
+        self.errors = errors
+        self.decode = decode
+
+    def __iter__(self):
+        with self._open() as f:
+            self.file = f
+            while True:
+                f.seek(self.offset_bytes, 0)
+                for raw in self._iter_raw_lines(f):
+                    if self.end_bytes is not None and self.offset_bytes >= self.end_bytes:
+                        return
+                    self.offset_bytes += len(raw)
+                    expected = self.offset_bytes
+                    yield raw.decode(self.encoding, self.errors) if self.decode else raw
+                    if self.offset_bytes != expected:  # 调用过 _unread_line，从新的偏移量重新读
+                        break
+                else:
+                    return
+
+    def _iter_raw_lines(self, f):
+        pending = b''
+        while True:
+            block = f.read(self.block_size)
+            if not block:
+                if pending and not self.skip_partial:  # 文件末尾没有换行符的最后一行
+                    yield pending
+                return
+            if pending:
+                block = pending + block
+            start = 0
+            while True:
+                end = block.find(b'\n', start)
+                if end < 0:
+                    break
+                yield block[start:end + 1]
+                start = end + 1
+            pending = block[start:]
+
+    def _unread_line(self, line):
+        if not isinstance(line, bytes):
+            line = line.encode(self.encoding, self.errors)
+        self.offset_bytes -= len(line)
+
+    def _open(self):
+        return open(self.file_path, 'rb')
+
+
+class GzipLogScanner(BlockLogScanner):
+    """流式读取 .gz 压缩的日志，不解压到磁盘，offset_bytes 为解压后的字节偏移"""
+
+    def _open(self):
+        return gzip.open(self.file_path, 'rb')
+
+
+class RotatedLogScanner(object):
+    """按时间顺序扫描 MultiProcessSafeDailyRotatingFileHandler 产生的一组文件
+    (file_path.YYYY-MM-DD[_HH[-MM]][.N][.gz] 以及指向当前文件的软链接 file_path)，.gz 文件流式读取
+
+    offsets 保存每个文件的扫描进度，以 inode 为键: {'inode': {'name': 文件名, 'offset': 字节偏移}}，
+    可以直接传入一个 FileDict，在合适的时机调用其 save()。文件被压缩成 .gz 后 inode 会变化，
+    此时按文件名沿用原文件的偏移量；读完的 .gz 文件会标记 done，不再重复解压；已不存在的文件的记录会被清除。
+
+    skip_partial 为 True（默认）时不返回当前文件末尾还没写完的半行，偏移量停在该行行首，下次扫描时再完整读出；
+    follow=True 时读到末尾后不退出，而是以 poll_interval 起、倍增至 max_interval 的间隔轮询新数据
+    和新文件，idle_timeout 秒内没有新数据或调用 stop() 后结束。
+    """
+    SUFFIX_PATTERN = r'\.(\d[\d_-]*)(?:\.(\d+))?(\.gz)?$'
+
+    def __init__(self, file_path, offsets=None, follow=False, poll_interval=0.1, max_interval=5,
+                 idle_timeout=None, skip_partial=True, **scanner_kwargs):
+        self.file_path = file_path
+        self.offsets = offsets if offsets is not None else {}
+        self.follow = follow
+        self.skip_partial = skip_partial
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.idle_timeout = idle_timeout
+        self.scanner_kwargs = scanner_kwargs
+        self.scanner = None
+        self._record = None
+        self._stopped = False
+        self._suffix_re = re.compile(re.escape(os.path.basename(file_path)) + self.SUFFIX_PATTERN)
+
+    def list_files(self):
+        """返回按时间先后排好序的文件列表"""
+        directory = os.path.dirname(self.file_path) or '.'
+        found = {}
+        for name in os.listdir(directory):
+            match = self._suffix_re.match(name)
+            if match:
+                suffix, index, gz = match.groups()
+                key = (suffix, int(index or 0))  # 按大小切分出的 .1 .2 ... 排在同一周期之后
+                if gz and key in found:  # 正在压缩中，优先读原文件
+                    continue
+                found[key] = os.path.join(directory, name)
+        files = [found[key] for key in sorted(found)]
+        if os.path.isfile(self.file_path) and not os.path.islink(self.file_path):
+            files.append(self.file_path)  # 未按日期切分的普通日志文件
+        return files
+
+    def stop(self):
+        self._stopped = True
+
+    def __iter__(self):
+        self._stopped = False
+        interval = self.poll_interval
+        idle_since = time.time()
+        while True:
+            received = False
+            files = self.list_files()
+            for i, path in enumerate(files):
+                for line in self._scan_file(path, self.skip_partial and i == len(files) - 1):
+                    received = True
+                    yield line
+            self._prune(files)
+            if not self.follow or self._stopped:
+                return
+            now = time.time()
+            if received:
+                interval, idle_since = self.poll_interval, now
+            elif self.idle_timeout is not None and now - idle_since >= self.idle_timeout:
+                return
+            else:
+                interval = min(interval * 2, self.max_interval)
+            time.sleep(interval)
+
+    def _scan_file(self, path, skip_partial):
+        try:
+            stat = os.stat(path)
+        except OSError:  # 扫描过程中被删除或压缩
+            return
+        key = str(stat.st_ino)
+        name = os.path.basename(path)
+        gz = name.endswith('.gz')
+        record = self.offsets.get(key)
+        if record is None or record.get('name') not in (name, name[:-3] if gz else name):
+            record = {'name': name, 'offset': 0}
+            if gz:
+                for old in self.offsets.values():
+                    if old.get('name') == name[:-3]:
+                        record['offset'] = old['offset']
+                        break
+        if record.get('done') or (not gz and record['offset'] == stat.st_size):
+            return
+        scanner_class = GzipLogScanner if gz else BlockLogScanner
+        self.scanner = scanner_class(path, record['offset'], skip_partial=skip_partial, **self.scanner_kwargs)
+        self._record = self.offsets[key] = record
+        for line in self.scanner:
+            record['offset'] = self.scanner.offset_bytes
+            yield line
+        record['offset'] = self.scanner.offset_bytes
+        if gz:
+            record['done'] = True
+        self.offsets[key] = record
+
+    def _prune(self, files):
+        alive = set()
+        for path in files:
+            try:
+                alive.add(str(os.stat(path).st_ino))
+            except OSError:
+                pass
+        directory = os.path.dirname(self.file_path) or '.'
+        for key in [k for k in self.offsets if k not in alive]:
+            record = self.offsets.pop(key)
+            name = record.get('name', '')
+            if name.endswith('.gz'):
+                continue
+            # 扫描过程中被压缩: .gz 先 rename 到位再删除原文件，把偏移量转给 .gz，避免下次从头读
+            gz_key = str(_inode(os.path.join(directory, name + '.gz')))
+            if gz_key != 'None' and gz_key not in self.offsets:
+                self.offsets[gz_key] = record
+
+    def _unread_line(self, line):
+        self.scanner._unread_line(line)
+        self._record['offset'] = self.scanner.offset_bytes
+
+
 class ReFilter(object):
     """调用 re.match 过滤匹配特定正则表达式的行，
-    迭代返回(pattern, line, match_result)"""
+    迭代返回(pattern, line, match_result)
+
+    所有 pattern 在初始化时预编译，并尽量合并成一个带标签分组的多选正则：
+    不匹配任何 pattern 的行只需测试一次；匹配的行从第一个命中的 pattern 开始，
+    再用字面量前缀预筛选后逐个确认，输出与逐个 re.match 完全一致
+    """
 
     def __init__(self, scanner, patterns):
         self.scanner = scanner
         self.patterns = patterns
+        self._compiled = [re.compile(pattern) for pattern in patterns]
+        self._prefixes = [_literal_prefix(c) for c in self._compiled]
+        self._combined = _combine_patterns(self._compiled)
 
     def __iter__(self):
+        patterns, compiled, prefixes, combined = self.patterns, self._compiled, self._prefixes, self._combined
         for line in self.scanner:
-            for pattern in self.patterns:
-                result = re.match(pattern, line)
+            first = 0
+            if combined is not None:
+                hit = combined.match(line)
+                if not hit:
+                    continue
+                first = int(hit.lastgroup[len(_TAG_PREFIX):])  # 在它之前的 pattern 都已确定不匹配
+            for i in range(first, len(compiled)):
+                if prefixes[i] and not line.startswith(prefixes[i]):
+                    continue
+                result = compiled[i].match(line)
                 if result:
-                    yield (pattern, line, result)
+                    yield (patterns[i], line, result)
+
+
+_TAG_PREFIX = '_re_filter_'
+_META_CHARS = frozenset('.^$*+?{}[]\\|()')
+_GROUP_NAME = re.compile(r'(?<!\\)(\(\?P<|\(\?P=|\(\?\()([A-Za-z_]\w*)')
+_UNSAFE_TO_COMBINE = re.compile(r'\\\d|\(\?\(\d')  # 数字反向引用/条件分组，合并后组号会错位
+
+
+def _literal_prefix(compiled):
+    """返回正则必须匹配的字面量前缀（re.match 从行首匹配，可用 startswith 预筛选）"""
+    source = compiled.pattern
+    if compiled.flags & (re.IGNORECASE | re.VERBOSE):
+        return source[:0]
+    text = source if isinstance(source, str) else source.decode('latin-1')
+    if '|' in text:
+        return source[:0]
+    end = 0
+    while end < len(text) and text[end] not in _META_CHARS:
+        end += 1
+    if end < len(text) and text[end] in '*?{':  # 量词作用于前一个字符
+        end -= 1
+    return source[:max(end, 0)]
+
+
+def _combine_patterns(compiled):
+    """
+    把多个 pattern 合并成 (?P<_re_filter_0>...)|(?P<_re_filter_1>...)，无法安全合并时返回 None
+    各 pattern 中的命名分组（如 TimedReFilter 都有的 log_time）加上 __序号 后缀避免重名；
+    合并后的正则只用于找出第一个可能匹配的 pattern，输出的 match 仍由原 pattern 产生，分组名不受影响
+    """
+    if len(compiled) < 2:
+        return None
+    sources = [c.pattern for c in compiled]
+    if len(set(type(s) for s in sources)) > 1 or len(set(c.flags for c in compiled)) > 1:
+        return None
+    texts = [s if isinstance(s, str) else s.decode('latin-1') for s in sources]
+    if any(_UNSAFE_TO_COMBINE.search(t) for t in texts):
+        return None
+    combined = '|'.join('(?P<%s%d>%s)' % (_TAG_PREFIX, i, _rename_groups(t, i)) for i, t in enumerate(texts))
+    if isinstance(sources[0], bytes):
+        combined = combined.encode('latin-1')
+    try:
+        return re.compile(combined, compiled[0].flags)
+    except re.error:  # 例如不同 pattern 中有同名分组
+        return None
+
+
+def _rename_groups(text, i):
+    """给 (?P<name>...)、(?P=name)、(?(name)...) 中的分组名加上 __i 后缀"""
+    return _GROUP_NAME.sub(lambda m: '%s%s__%d' % (m.group(1), m.group(2), i), text)
 
 
 class TimedReFilter(object):
     """比 ReFilter 多了一个检查时间的功能
     要求表达式中含有 ?P<log_time> 命名组
+
+    日志按时间有序时，可以指定 seek=True，迭代前先按字节位置二分查找，
+    直接跳到第一条时间 >= start 的行（不会早于 scanner 原有的偏移量）；
+    再指定 index=True 会在日志旁维护一个稀疏的 时间→偏移 索引文件（见 TimeIndex），
+    重复查询同一文件的不同时间窗口时只需要很少的探测
     """
 
-    def __init__(self, scanner, patterns, start, end, time_format=''):
+    def __init__(self, scanner, patterns, start, end, time_format='', seek=False, index=False):
         self.re_filter = ReFilter(scanner, patterns)
         self.start = start
         self.end = end
         self.time_format = time_format
+        self.seek = seek or index
+        self.index = index
 
     def __iter__(self):
+        if self.seek and self.start and self.time_format:
+            self._seek_to_start()
         for pattern, line, result in self.re_filter:
             log_time = result.groupdict().get('log_time', '')
             if self.time_format:
@@ -88,10 +386,426 @@ class TimedReFilter(object):
                         pass
                     elif self.end and log_time > self.end:  # 过晚数据，不读
                         self.re_filter.scanner._unread_line(line)
-                        raise StopIteration
+                        return
                     else:
                         yield (pattern, line, result)
 
+    def parse_time(self, line):
+        """返回行内 log_time 解析出的时间，无法解析时返回 None"""
+        for compiled in self.re_filter._compiled:
+            result = compiled.match(line)
+            if result:
+                try:
+                    return datetime.datetime.strptime(result.groupdict().get('log_time', ''), self.time_format)
+                except Exception:
+                    continue
+        return None
+
+    def _seek_to_start(self):
+        scanner = self.re_filter.scanner
+        time_index = TimeIndex(scanner.file_path, self.parse_time) if self.index else None
+        scanner.offset_bytes = seek_time_offset(scanner.file_path, self.start, self.parse_time,
+                                                scanner.offset_bytes, time_index)
+
+
+class JsonFilter(object):
+    """过滤 log_handler.JsonFormatter 输出的 JSON 行日志，迭代返回 (record, line)
+
+    - conditions: {字段: 值}，值也可以是 set/list/tuple（任一即可）或可调用对象（返回真值即可）
+    - start/end: datetime（本地时间）或 epoch 秒，按 time_field 字段过滤；与 TimedReFilter 一样，
+      遇到晚于 end 的行时退回该行并结束；seek=True 时先二分查找到 start 附近
+    取时间时直接读取行首的 time_field，ASCII 字符串条件会先在原始行上做子串预筛选，不满足的行不必 json.loads
+    """
+
+    def __init__(self, scanner, conditions=None, start=None, end=None, time_field='ts', seek=False):
+        self.scanner = scanner
+        self.conditions = conditions or {}
+        self.start = _to_epoch(start)
+        self.end = _to_epoch(end)
+        self.time_field = time_field
+        self.seek = seek
+        self._time_prefix = '{' + json.dumps(time_field) + ':'
+        self._needles = []
+        for value in self.conditions.values():
+            if isinstance(value, basestring):
+                needle = json.dumps(value)
+                if needle == json.dumps(value, ensure_ascii=False):  # 两种编码方式一致时才能安全预筛选
+                    self._needles.append(needle)
+        self._checks = []
+        for field, value in self.conditions.items():
+            if callable(value):
+                self._checks.append((field, value))
+            elif isinstance(value, (set, frozenset, list, tuple)):
+                self._checks.append((field, frozenset(value).__contains__))
+            else:
+                self._checks.append((field, functools.partial(operator.eq, value)))
+
+    def __iter__(self):
+        if self.seek and self.start is not None:
+            self.scanner.offset_bytes = seek_time_offset(self.scanner.file_path, self.start, self.parse_time,
+                                                         self.scanner.offset_bytes)
+        start, end, needles, checks = self.start, self.end, self._needles, self._checks
+        timed = start is not None or end is not None
+        for line in self.scanner:
+            if needles and not all(needle in line for needle in needles):
+                continue
+            if timed:
+                log_time = self.parse_time(line)
+                if log_time is None:
+                    continue
+                if start is not None and log_time < start:  # 过早数据，丢弃
+                    continue
+                if end is not None and log_time > end:  # 过晚数据，不读
+                    self.scanner._unread_line(line)
+                    return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if all(field in record and check(record[field]) for field, check in checks):
+                yield (record, line)
+
+    def parse_time(self, line):
+        """返回行的 epoch 时间，无法解析时返回 None"""
+        if line.startswith(self._time_prefix):
+            head = len(self._time_prefix)
+            stop = line.find(',', head)
+            try:
+                return float(line[head:stop] if stop > 0 else line[head:].rstrip().rstrip('}'))
+            except ValueError:
+                pass
+        try:
+            return float(json.loads(line)[self.time_field])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+
+def _to_epoch(value):
+    if isinstance(value, datetime.datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+    return value
+
+
+def _probe_time(f, pos, parse_time, limit=None):
+    """从 pos 之后的第一个完整行开始，找到第一条能解析出时间的行，
+    返回 (行首偏移, 时间, 行尾偏移)，到达 limit 或文件末尾时返回 None"""
+    if pos > 0:
+        f.seek(pos - 1, 0)
+        f.readline()  # 跳过 pos 所在的不完整行
+    else:
+        f.seek(0, 0)
+    line_start = f.tell()
+    while limit is None or line_start < limit:
+        line = f.readline()
+        if not line:
+            return None
+        line_end = line_start + len(line)
+        log_time = parse_time(line.decode('utf-8', 'replace'))
+        if log_time is not None:
+            return line_start, log_time, line_end
+        line_start = line_end
+    return None
+
+
+def seek_time_offset(file_path, start, parse_time, offset_bytes=0, time_index=None):
+    """在按时间有序的日志中二分查找，返回一个行首字节偏移，保证其之前（offset_bytes 之后）
+    所有能解析出时间的行都早于 start。只在探测点调用 parse_time(line) -> datetime or None
+
+    time_index 为 TimeIndex 时，先用索引把查找范围缩小到两个相邻索引点之间
+    """
+    lo, hi = offset_bytes, os.path.getsize(file_path)
+    if time_index is not None:
+        lo, hi = time_index.bounds(start, lo, hi)
+    with open(file_path, 'rb') as f:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = _probe_time(f, mid, parse_time, hi)
+            if probe is None or probe[1] >= start:
+                hi = mid
+            else:
+                lo = probe[2]
+    return lo
+
+
+class TimeIndex(object):
+    """稀疏的 时间→字节偏移 索引，默认保存在日志旁的 file_path + '.tidx'
+
+    每隔 stride 字节记录一个探测点（该区间内第一条带时间的行），文件增长后只追加新区间；
+    日志文件被替换（inode 变化）、截断或 stride 变化时重建。
+    索引文件首行为 "# inode<TAB>stride"，之后每个区间一行 "时间<TAB>偏移"，区间内没有带时间的行时为 "-"
+    """
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, file_path, parse_time, stride=4 * 1024 * 1024, index_path=None):
+        self.file_path = file_path
+        self.parse_time = parse_time
+        self.stride = stride
+        self.index_path = index_path or file_path + '.tidx'
+        self.points = []
+        self.indexed_bytes = 0
+        self.update()
+
+    def bounds(self, start, lo, hi):
+        """把 [lo, hi) 缩小到可能包含 start 的两个相邻索引点之间"""
+        i = bisect.bisect_left(self.points, (start, -1))
+        if i > 0:
+            lo = max(lo, self.points[i - 1][1])
+        if i < len(self.points):
+            hi = max(lo, min(hi, self.points[i][1]))
+        return lo, hi
+
+    def update(self):
+        stat = os.stat(self.file_path)
+        if not self._load(stat):
+            self.points, self.indexed_bytes = [], 0
+            with open(self.index_path, 'w') as f:
+                f.write('# %d\t%d\n' % (stat.st_ino, self.stride))
+        records = []
+        with open(self.file_path, 'rb') as f:
+            while self.indexed_bytes + self.stride <= stat.st_size:  # 只索引已写满的区间
+                probe = _probe_time(f, self.indexed_bytes, self.parse_time, self.indexed_bytes + self.stride)
+                if probe is None:
+                    records.append('-\n')
+                else:
+                    self.points.append((probe[1], probe[0]))
+                    records.append('%s\t%d\n' % (probe[1].strftime(self.TIME_FORMAT), probe[0]))
+                self.indexed_bytes += self.stride
+        if records:
+            with open(self.index_path, 'a') as f:
+                f.writelines(records)
+        return self
+
+    def _load(self, stat):
+        try:
+            with open(self.index_path, 'r') as f:
+                header = f.readline()
+                records = f.readlines()
+        except (IOError, OSError):
+            return False
+        if header != '# %d\t%d\n' % (stat.st_ino, self.stride):
+            return False
+        if not all(r.endswith('\n') for r in records):  # 上次写入不完整
+            return False
+        if len(records) * self.stride > stat.st_size:  # 文件被截断
+            return False
+        points = []
+        for record in records:
+            if record != '-\n':
+                log_time, offset = record.rstrip('\n').split('\t')
+                points.append((datetime.datetime.strptime(log_time, self.TIME_FORMAT), int(offset)))
+        self.points = points
+        self.indexed_bytes = len(records) * self.stride
+        return True
+
+
+_END = object()
+_ERROR = object()
+
+
+class BatchProcessor(object):
+    """Processor: 把 Filter 的输出按 batch_size 条或 max_wait 秒分批，交给线程池执行 handler(batch)
+
+    - 最多 max_pending 个批次在处理中，超出时暂停读取（背压），避免积压无限增长
+    - 每个批次记录其最后一条数据读完时 scanner 的 offset_bytes；只有它及之前的批次都处理成功后，
+      才按顺序调用 on_commit(offset_bytes)（在工作线程中调用），因此提交的偏移量之前的数据一定都已处理；
+      全部处理完后会再提交一次 scanner 最终的偏移量
+    - handler 抛出异常后停止读取，失败批次之前的批次仍会在处理成功后按顺序提交，失败批次及之后的不再提交；
+      run() 等待已提交的批次结束后重新抛出（序号最小的）失败批次的异常
+
+    eg: BatchProcessor(bulk_insert, on_commit=save_offset).run(ReFilter(scanner, patterns), scanner)
+    """
+
+    def __init__(self, handler, batch_size=500, max_wait=1.0, workers=4, max_pending=None, on_commit=None):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.max_pending = max_pending or workers * 2
+        self.on_commit = on_commit
+        self.offset_bytes = None
+
+    def run(self, items, scanner=None):
+        """处理 items 直到耗尽，返回最后提交的偏移量"""
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._acked = {}
+        self._next_commit = 0
+        self._error = None
+        self._failed_seq = None
+        self._stopping = threading.Event()
+        source = queue.Queue(maxsize=self.batch_size * 2)
+        reader = threading.Thread(target=self._read, args=(items, scanner, source))
+        reader.daemon = True
+        reader.start()
+        executor = ThreadPoolExecutor(self.workers)
+        seq, batch, offset_bytes, deadline = 0, [], None, None
+        try:
+            while self._error is None:
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.time())
+                    kind, item, item_offset = source.get(timeout=timeout)
+                except queue.Empty:  # 超过 max_wait，提交不满的批次
+                    kind = None
+                else:
+                    if kind is _END:
+                        break
+                    elif kind is _ERROR:
+                        raise item
+                    batch.append(item)
+                    offset_bytes = item_offset
+                    if deadline is None:
+                        deadline = time.time() + self.max_wait
+                if batch and (kind is None or len(batch) >= self.batch_size):
+                    self._submit(executor, seq, batch, offset_bytes)
+                    seq, batch, deadline = seq + 1, [], None
+            if batch and self._error is None:
+                self._submit(executor, seq, batch, offset_bytes)
+        finally:
+            self._stopping.set()
+            executor.shutdown(wait=True)
+        if self._error is not None:
+            raise self._error
+        if scanner is not None:
+            self._commit(scanner.offset_bytes)
+        return self.offset_bytes
+
+    def _read(self, items, scanner, source):
+        try:
+            for item in items:
+                self._put(source, (item, item, scanner.offset_bytes if scanner is not None else None))
+                if self._stopping.is_set():
+                    return
+            self._put(source, (_END, None, None))
+        except Exception as e:
+            self._put(source, (_ERROR, e, None))
+
+    def _put(self, source, value):
+        while not self._stopping.is_set():
+            try:
+                source.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _submit(self, executor, seq, batch, offset_bytes):
+        self._slots.acquire()  # 背压: 处理中的批次过多时在这里等待
+        future = executor.submit(self.handler, batch)
+        future.add_done_callback(lambda f: self._done(seq, offset_bytes, f))
+
+    def _done(self, seq, offset_bytes, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None:
+                if self._failed_seq is None or seq < self._failed_seq:
+                    self._failed_seq = seq
+                    self._error = future.exception()
+                return
+            self._acked[seq] = offset_bytes
+            while self._next_commit in self._acked and \
+                    (self._failed_seq is None or self._next_commit < self._failed_seq):
+                self._commit(self._acked.pop(self._next_commit))
+                self._next_commit += 1
+
+    def _commit(self, offset_bytes):
+        if offset_bytes is None:
+            return
+        self.offset_bytes = offset_bytes
+        if self.on_commit is not None:
+            self.on_commit(offset_bytes)
+
+
+def split_file(file_path, offset_bytes=0, end_bytes=None, chunk_bytes=64 * 1024 * 1024):
+    """把 [offset_bytes, end_bytes) 切分成按行对齐的若干 (start, end) 字节区间"""
+    if end_bytes is None:
+        end_bytes = os.path.getsize(file_path)
+    chunks = []
+    with open(file_path, 'rb') as f:
+        start = offset_bytes
+        while start < end_bytes:
+            f.seek(min(start + chunk_bytes, end_bytes) - 1, 0)
+            f.readline()  # 对齐到下一行行首
+            end = min(f.tell(), end_bytes)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+_NO_INITIAL = object()
+
+
+def _scan_chunk(task):
+    file_path, start, end, patterns, processor, filter_class, filter_kwargs, scanner_kwargs, reducer = task
+    scanner = BlockLogScanner(file_path, start, end_bytes=end, **scanner_kwargs)
+    results = (processor(item) for item in filter_class(scanner, patterns, **filter_kwargs))
+    if reducer is None:
+        results = list(results)
+    else:  # 区间内没有结果时为空 tuple，否则为只含归约结果的 tuple
+        first = next(results, _NO_INITIAL)
+        results = () if first is _NO_INITIAL else (reduce(reducer, results, first),)
+    # 过滤器提前结束（如 TimedReFilter 遇到过晚数据）时，偏移量停在 end 之前
+    return results, scanner.offset_bytes, scanner.offset_bytes >= end
+
+
+class ParallelScanner(object):
+    """把单个大文件切分成按行对齐的区间，在进程池中并行执行 Filter 和 processor
+
+    - 迭代时按文件顺序返回 processor(item) 的结果
+    - reduce() 先在各进程内归约，再在主进程按文件顺序合并各区间的结果
+    两种方式结束后 offset_bytes 都是串行扫描会停下的字节偏移，可以照常记录。
+    processor/reducer/combiner 需要能被 pickle（模块级函数），因为 match 对象无法跨进程传递，
+    processor 在子进程中执行。扫描范围是开始时的文件大小，之后追加的内容留给下一次扫描。
+    """
+
+    def __init__(self, file_path, patterns, processor, offset_bytes=0, filter_class=None,
+                 filter_kwargs=None, processes=None, chunk_bytes=64 * 1024 * 1024, scanner_kwargs=None):
+        self.file_path = file_path
+        self.patterns = patterns
+        self.processor = processor
+        self.offset_bytes = offset_bytes
+        self.filter_class = filter_class or ReFilter
+        self.filter_kwargs = filter_kwargs or {}
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        self.scanner_kwargs = scanner_kwargs or {}
+
+    def __iter__(self):
+        for results, offset_bytes, completed in self._run():
+            for result in results:
+                yield result
+            self.offset_bytes = offset_bytes
+            if not completed:
+                return
+
+    def reduce(self, reducer, initial=_NO_INITIAL, combiner=None):
+        """
+        reducer(acc, result) 用于区间内归约，combiner(acc, acc) 用于合并区间结果，默认同 reducer
+        与 functools.reduce 相同，区间内以第一个结果为初值；initial 只在合并时作为最左边的值使用一次，
+        不指定 initial 且没有任何结果时返回 None
+        """
+        combiner = combiner or reducer
+        total = initial
+        for results, offset_bytes, completed in self._run(reducer):
+            if results:
+                total = results[0] if total is _NO_INITIAL else combiner(total, results[0])
+            self.offset_bytes = offset_bytes
+            if not completed:
+                break
+        return None if total is _NO_INITIAL else total
+
+    def _run(self, reducer=None):
+        tasks = [(self.file_path, start, end, self.patterns, self.processor, self.filter_class,
+                  self.filter_kwargs, self.scanner_kwargs, reducer)
+                 for start, end in split_file(self.file_path, self.offset_bytes, chunk_bytes=self.chunk_bytes)]
+        if not tasks:
+            return
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for chunk_result in pool.imap(_scan_chunk, tasks):
+                yield chunk_result
+            pool.close()
+        finally:
+            pool.terminate()
+
 
 class FileDict(dict):
     def __init__(self, file_path):
@@ -106,7 +820,222 @@ class FileDict(dict):
                     self.update(record)
 
     def save(self):
-        with open(self._file_path, 'w') as f:
-            json.dump(self, f, sort_keys=True, indent=4)
-            f.write('\n')
+        _dump_json_atomic(self._file_path, self)
+        return self
+
+
+def _dump_json_atomic(file_path, data):
+    """先写临时文件再 rename，写到一半崩溃也不会破坏原文件"""
+    tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=4)
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, file_path)
+
+
+_DELETED = object()
+
+
+def _inode(file_path):
+    try:
+        return os.stat(file_path).st_ino
+    except OSError:
+        return None
+
+
+class JournaledFileDict(dict):
+    """与 FileDict 用法相同的检查点存储，但 save() 只把变化的键追加到 file_path + '.journal'，
+    代价与变化量成正比，而不是每次重写整个文件
+
+    - 加载时读取快照 file_path（与 FileDict 格式相同，可直接接管已有的记录），再重放日志；
+      崩溃时写了一半的日志行会被忽略
+    - 日志记录数达到 compact_records 时，合并写入新快照并原子替换，再换上空日志
+    - 多个进程可以共享同一个文件: save() 在文件锁内先合并其他进程写入的变化（本进程未修改的键），
+      再追加本进程的变化
+    - 与 JSON 一致，键只能是字符串；fsync=True 时每次 save() 都落盘
+    - 日志第一行记录代号（每次合并时在文件锁内随机生成），进程据此判断快照和日志是否已被其他进程合并替换；
+      不能用 inode 判断，ext4 会在 rename 替换后复用 inode 号
+
+    多个进程各自更新自己的键，期间多次合并，最终不丢失任何更新:
+    >>> import multiprocessing, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'offsets.json')
+    >>> def worker(n):
+    ...     store = JournaledFileDict(path, compact_records=7)
+    ...     for i in range(30):
+    ...         store[str(n)] = i
+    ...         store.save()
+    >>> processes = [multiprocessing.get_context('fork').Process(target=worker, args=(n,)) for n in range(6)]
+    >>> for p in processes: p.start()
+    >>> for p in processes: p.join()
+    >>> sorted(JournaledFileDict(path).items())
+    [('0', 29), ('1', 29), ('2', 29), ('3', 29), ('4', 29), ('5', 29)]
+    """
+
+    def __init__(self, file_path, compact_records=1000, fsync=False):
+        self._file_path = file_path
+        self._journal_path = file_path + '.journal'
+        self._lock_path = file_path + '.lock'
+        self._compact_records = compact_records
+        self._fsync = fsync
+        self._persisted = {}  # 磁盘上的状态: key -> json 字符串
+        self._generation = None
+        self._journal_pos = 0
+        self._journal_records = 0
+        with self._locked():
+            self._sync({}, reload=True)
+
+    def save(self):
+        with self._locked():
+            dirty = self._dirty()
+            self._sync(dirty)
+            if dirty:
+                self._append(dirty)
+            if self._journal_records >= self._compact_records:
+                self._compact()
         return self
+
+    def compact(self):
+        with self._locked():
+            dirty = self._dirty()
+            self._sync(dirty)
+            if dirty:
+                self._append(dirty)
+            self._compact()
+        return self
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _dirty(self):
+        dirty = {}
+        for key, value in self.items():
+            dumped = json.dumps(value, sort_keys=True)
+            if self._persisted.get(key) != dumped:
+                dirty[key] = dumped
+        for key in self._persisted:
+            if key not in self:
+                dirty[key] = None
+        return dirty
+
+    def _sync(self, dirty, reload=False):
+        """读入其他进程的变化，dirty 中的键以本进程为准"""
+        try:
+            stat = os.stat(self._journal_path)
+        except OSError:
+            stat = None
+        generation = self._read_generation()
+        changes = {}
+        if reload or generation != self._generation or (stat.st_size if stat else 0) < self._journal_pos:
+            # 首次加载，或快照/日志已被其他进程合并替换
+            reload = True
+            if os.path.exists(self._file_path):
+                with open(self._file_path, 'r') as f:
+                    try:
+                        changes.update(json.load(f))
+                    except Exception:
+                        pass
+            self._generation = generation
+            self._journal_pos = self._journal_records = 0
+        if stat is not None and stat.st_size > self._journal_pos:
+            with open(self._journal_path, 'rb') as f:
+                f.seek(self._journal_pos, 0)
+                data = f.read()
+            complete = data.rfind(b'\n') + 1  # 忽略写了一半的最后一行
+            for line in data[:complete].splitlines():
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except Exception:
+                    continue
+                if 'g' in record:  # 日志头
+                    continue
+                changes[record['k']] = _DELETED if record.get('d') else record['v']
+                self._journal_records += 1
+            self._journal_pos += complete
+        if reload:
+            for key in [k for k in self._persisted if k not in changes]:
+                changes[key] = _DELETED
+        for key, value in changes.items():
+            if value is _DELETED:
+                self._persisted.pop(key, None)
+                if key not in dirty:
+                    self.pop(key, None)
+            else:
+                self._persisted[key] = json.dumps(value, sort_keys=True)
+                if key not in dirty:
+                    dict.__setitem__(self, key, value)
+
+    def _append(self, dirty):
+        lines = []
+        for key, dumped in dirty.items():
+            if dumped is None:
+                lines.append('{"k": %s, "d": 1}\n' % json.dumps(key))
+            else:
+                lines.append('{"k": %s, "v": %s}\n' % (json.dumps(key), dumped))
+        data = ''.join(lines).encode('utf-8')
+        with open(self._journal_path, 'ab') as f:
+            f.seek(0, 2)
+            size = f.tell()
+            if size == 0:  # 新建的日志，先写日志头
+                self._generation = uuid.uuid4().hex
+                data = _journal_header(self._generation) + data
+            elif size > self._journal_pos:  # 上次崩溃留下的半行，先补上换行
+                data = b'\n' + data
+            f.write(data)
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        self._journal_pos = size + len(data)
+        self._journal_records += len(lines)
+        for key, dumped in dirty.items():
+            if dumped is None:
+                self._persisted.pop(key, None)
+            else:
+                self._persisted[key] = dumped
+
+    def _compact(self):
+        _dump_json_atomic(self._file_path, self)
+        generation = uuid.uuid4().hex
+        header = _journal_header(generation)
+        tmp_path = '%s.%d.tmp' % (self._journal_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self._journal_path)  # 崩溃在两次 rename 之间时，重放旧日志的结果与新快照一致
+        self._generation = generation
+        self._journal_pos = len(header)
+        self._journal_records = 0
+
+    def _read_generation(self):
+        """日志头中的代号，日志不存在或是没有日志头的旧格式时为 None"""
+        try:
+            with open(self._journal_path, 'rb') as f:
+                line = f.readline()
+        except (IOError, OSError):
+            return None
+        if not line.startswith(b'{"g":') or not line.endswith(b'\n'):
+            return None
+        try:
+            return json.loads(line.decode('utf-8'))['g']
+        except Exception:
+            return None
+
+
+def _journal_header(generation):
+    return ('{"g": %s}\n' % json.dumps(generation)).encode('utf-8')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
-from smtplib import SMTP_SSL
+import socket
+import threading
+import time
+from contextlib import contextmanager
 from email.mime.text import MIMEText
+from smtplib import SMTP, SMTP_SSL, SMTPServerDisconnected
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 DEFAULT_SMTP_CONFIG = {
     'host': 'smtp.exmail.qq.com',
@@ -11,12 +20,37 @@ DEFAULT_SMTP_CONFIG = {
     'timeout': 10,
 }
 
+# 这些异常说明连接已不可用，换一个新连接重发；其他异常（如收件人被拒）与连接无关，直接交给调用方
+_CONNECTION_ERRORS = (SMTPServerDisconnected, ConnectionError, socket.timeout)
+
 
-def send_mail(subject, content, dst_emails, smtp_config=DEFAULT_SMTP_CONFIG):
+def send_mail(subject, content, dst_emails, smtp_config=DEFAULT_SMTP_CONFIG, pool=None):
+    """pool 为 SMTPPool 时复用其中已登录的连接，否则为这一封邮件单独建立连接"""
     if not dst_emails:
         return
+    if pool is not None:
+        return pool.send(subject, content, dst_emails)
     if not smtp_config:
         return
+    smtp = _connect(smtp_config)
+    smtp.sendmail(_user_name(smtp_config), dst_emails, _build_message(subject, content, dst_emails, smtp_config))
+    smtp.quit()
+
+
+def _user_name(smtp_config):
+    return '%s<%s>' % (smtp_config.get('sender', ''), smtp_config['account'])
+
+
+def _build_message(subject, content, dst_emails, smtp_config):
+    msg = MIMEText(content, _subtype='html', _charset='utf-8')
+    msg['From'] = _user_name(smtp_config)
+    msg['Subject'] = subject
+    msg['To'] = ';'.join(dst_emails)
+    return msg.as_string()
+
+
+def _connect(smtp_config):
+    """smtp_config['ssl'] 为 False 时使用明文 SMTP（如本地测试用的 SMTP 服务），password 为空时不登录"""
     host_info = {'host': smtp_config['host']}
     port = int(smtp_config.get('port', 0))
     if port:
@@ -27,12 +61,149 @@ def send_mail(subject, content, dst_emails, smtp_config=DEFAULT_SMTP_CONFIG):
     timeout = int(smtp_config.get('timeout', 0))
     if timeout:
         host_info['timeout'] = timeout
-    msg = MIMEText(content, _subtype='html', _charset='utf-8')
-    user_name = '%s<%s>' % (smtp_config.get('sender', ''), smtp_config['account'])
-    msg['From'] = user_name
-    msg['Subject'] = subject
-    msg['To'] = ';'.join(dst_emails)
-    smtp = SMTP_SSL(**host_info)
-    smtp.login(smtp_config['account'], smtp_config['password'])
-    smtp.sendmail(user_name, dst_emails, msg.as_string())
-    smtp.quit()
+    smtp_class = SMTP_SSL if smtp_config.get('ssl', True) else SMTP
+    smtp = smtp_class(**host_info)
+    if smtp_config.get('password'):
+        smtp.login(smtp_config['account'], smtp_config['password'])
+    return smtp
+
+
+def _close(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        smtp.close()
+
+
+class SMTPPool(object):
+    """线程安全的 SMTP 连接池，保持已登录的连接，避免每封邮件都重新握手和登录
+
+    - 最多同时打开 size 个连接，空闲超过 idle_timeout 秒的连接在复用前先 NOOP 检查
+    - 连接断开时自动换新连接重发，最多重试 retries 次
+    - max_per_connection 限制单个连接发送的邮件数，达到后重新连接（应对服务商的单连接限额）
+    用法:
+        pool = SMTPPool(smtp_config)
+        send_mail(subject, content, dst_emails, pool=pool)
+        failures = pool.send_many([(subject, content, dst_emails), ...])
+        pool.close()
+    """
+
+    def __init__(self, smtp_config=DEFAULT_SMTP_CONFIG, size=2, idle_timeout=60, retries=1, max_per_connection=0):
+        self.smtp_config = smtp_config
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.max_per_connection = max_per_connection
+        self._idle = queue.LifoQueue()  # (smtp, 上次使用时间, 已发送数)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self, fresh=False):
+        """
+        取出一个可用连接，yield [smtp, 已发送数]；出现连接错误时丢弃该连接，否则放回池中
+        fresh 为 True 时不复用空闲连接而是新建（重试时使用，池中其他空闲连接很可能也已失效）
+        """
+        with self._slots:
+            conn = [_connect(self.smtp_config), 0] if fresh else self._acquire()
+            broken = False
+            try:
+                yield conn
+            except _CONNECTION_ERRORS:
+                broken = True
+                raise
+            finally:
+                if broken:
+                    _close(conn[0])
+                else:
+                    self._idle.put((conn[0], time.time(), conn[1]))
+
+    def _acquire(self):
+        while True:
+            try:
+                smtp, last_used, sent = self._idle.get_nowait()
+            except queue.Empty:
+                return [_connect(self.smtp_config), 0]
+            if time.time() - last_used <= self.idle_timeout:
+                return [smtp, sent]
+            try:
+                if smtp.noop()[0] == 250:
+                    return [smtp, sent]
+            except Exception:
+                pass
+            _close(smtp)
+
+    def send(self, subject, content, dst_emails):
+        """发送一封邮件，返回 smtplib.sendmail 的结果（被拒绝的收件人）"""
+        msg = _build_message(subject, content, dst_emails, self.smtp_config)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection(fresh=attempt > 0) as conn:
+                    return self._sendmail(conn, dst_emails, msg)
+            except _CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+
+    def send_many(self, messages):
+        """
+        在同一个连接上依次发送多封邮件，messages 为 (subject, content, dst_emails) 的可迭代对象
+        连接断开时换新连接继续，单封邮件的失败不影响其余邮件，返回失败列表 [(序号, 异常)]
+        """
+        failures = []
+        messages = iter(enumerate(messages))
+        pending = None  # 因连接断开需要重发的 (序号, 邮件, 已重试次数)
+        fresh = False
+        while True:
+            try:
+                with self.connection(fresh) as conn:
+                    while True:
+                        if pending is None:
+                            try:
+                                i, (subject, content, dst_emails) = next(messages)
+                            except StopIteration:
+                                return failures
+                            if not dst_emails:
+                                continue
+                            pending = (i, (dst_emails, _build_message(subject, content, dst_emails, self.smtp_config)), 0)
+                        i, (dst_emails, msg), attempts = pending
+                        try:
+                            self._sendmail(conn, dst_emails, msg)
+                        except _CONNECTION_ERRORS:
+                            raise
+                        except Exception as e:
+                            failures.append((i, e))
+                        pending = None
+            except _CONNECTION_ERRORS as e:
+                if pending is None:  # 建立连接时失败，没有正在发送的邮件
+                    raise
+                fresh = True
+                i, payload, attempts = pending
+                if attempts >= self.retries:
+                    failures.append((i, e))
+                    pending = None
+                else:
+                    pending = (i, payload, attempts + 1)
+
+    def _sendmail(self, conn, dst_emails, msg):
+        """send/send_many 都经过这里，连接发送数达到 max_per_connection 时先换新连接"""
+        if self.max_per_connection and conn[1] >= self.max_per_connection:
+            smtp = _connect(self.smtp_config)
+            _close(conn[0])
+            conn[:] = [smtp, 0]
+        result = conn[0].sendmail(_user_name(self.smtp_config), dst_emails, msg)
+        conn[1] += 1
+        return result
+
+    def close(self):
+        """关闭池中所有空闲连接，正在使用的连接归还后仍会放回池中"""
+        while True:
+            try:
+                smtp, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close(smtp)
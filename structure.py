@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
+import sys
+from collections.abc import Mapping, MutableMapping, MutableSequence
 
 __all__ = [
     'Storage',
+    'storage',
+    'Record',
+    'record_type',
+    'StorageView',
+    'StorageListView',
+    'storage_view',
 ]
 
 
@@ -29,7 +37,7 @@ class Storage(dict):
         try:
             return self[key]
         except KeyError as k:
-            raise AttributeError(k.message)
+            raise AttributeError(k)
 
     def __setattr__(self, key, value):
         self[key] = value
@@ -38,7 +46,278 @@ class Storage(dict):
         try:
             del self[key]
         except KeyError as k:
-            raise AttributeError(k.message)
+            raise AttributeError(k)
 
     def __repr__(self):
         return '<Storage ' + dict.__repr__(self) + '>'
+
+
+storage = Storage
+
+
+class Record(Mapping):
+    """
+    由 record_type 生成的定长记录的基类，字段存放在 __slots__ 中，
+    同样支持 `obj.foo` 与 `obj['foo']`，并实现只读的 Mapping 接口（keys/items/get/in/==）。
+    未赋值的字段视为不存在的键；只能给声明过的字段赋值。
+    """
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self._fields):
+            raise TypeError('%s takes at most %d positional arguments (%d given)' %
+                            (type(self).__name__, len(self._fields), len(args)))
+        for name, value in zip(self._fields, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            if name not in self._field_set:
+                raise TypeError('%s got an unexpected field %r' % (type(self).__name__, name))
+            setattr(self, name, value)
+
+    @classmethod
+    def _make(cls, values):
+        """按字段顺序从序列（如数据库游标返回的 tuple）构造记录"""
+        record = cls.__new__(cls)
+        for name, value in zip(cls._fields, values):
+            setattr(record, name, value)
+        return record
+
+    @classmethod
+    def from_dict(cls, data):
+        """从 dict/Storage 构造记录，只取声明过的字段"""
+        record = cls.__new__(cls)
+        for name in cls._fields:
+            if name in data:
+                setattr(record, name, data[name])
+        return record
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._field_set and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return default
+
+    def __iter__(self):
+        for name in self._fields:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, dict(self.items()))
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def record_type(typename, fields):
+    """
+    按字段列表生成 Record 子类，用于在内存中保存大量同构的行（如数据库查询结果）。
+    与 Storage 相比，每行不再需要一个 dict，占用内存小得多，属性访问也直接走 slot。
+    记录可以直接交给 transform.obj2dict / obj2json / dict_project 处理。
+    fields 可以是字段名列表，也可以是以空格或逗号分隔的字符串。
+        >>> User = record_type('User', 'id name email')
+        >>> u = User(1, 'foo', email='foo@example.com')
+        >>> u.name
+        'foo'
+        >>> u['email']
+        'foo@example.com'
+        >>> u.name = 'bar'
+        >>> u['name']
+        'bar'
+        >>> User._make((2, 'baz'))
+        <User {'id': 2, 'name': 'baz'}>
+        >>> u.age = 18
+        Traceback (most recent call last):
+            ...
+        AttributeError: 'User' object has no attribute 'age'
+    """
+    if isinstance(fields, str):
+        fields = fields.replace(',', ' ').split()
+    fields = tuple(fields)
+    for name in fields:
+        if not name.isidentifier() or name.startswith('_'):
+            raise ValueError('字段名必须是不以下划线开头的合法标识符: %r' % name)
+        if hasattr(Record, name):
+            raise ValueError('字段名与 Record 的方法重名: %r' % name)
+    if len(set(fields)) != len(fields):
+        raise ValueError('字段名重复: %r' % (fields,))
+    cls = type(typename, (Record,), {
+        '__slots__': fields,
+        '_fields': fields,
+        '_field_set': frozenset(fields),
+    })
+    try:  # 与 namedtuple 相同，使生成的类可以被 pickle
+        cls.__module__ = sys._getframe(1).f_globals.get('__name__', '__main__')
+    except (AttributeError, ValueError):
+        pass
+    return cls
+
+
+def _wrap(view, key, value):
+    """按需把 dict/list 包装成视图，并按 key 缓存；底层对象被替换后重新包装"""
+    if isinstance(value, dict):
+        wrapper_cls = StorageView
+    elif isinstance(value, list):
+        wrapper_cls = StorageListView
+    else:
+        return value
+    cache = view._cache
+    wrapper = cache.get(key)
+    if wrapper is None or wrapper._data is not value:
+        wrapper = cache[key] = wrapper_cls(value)
+    return wrapper
+
+
+def _unwrap(value):
+    if isinstance(value, (StorageView, StorageListView)):
+        return value._data
+    return value
+
+
+class StorageView(MutableMapping):
+    """
+    dict 的惰性视图，支持 `obj.a.b.c` 式的属性访问，不复制底层数据。
+    嵌套的 dict/list 在第一次访问时才包装成视图并缓存，写入（包括嵌套视图上的写入）直接作用于原始对象，
+    适合只读写大文档中少数字段的场景；需要整体转成 Storage 时仍然可以用 Storage 递归构造。
+        >>> data = {'a': {'b': {'c': 1}}, 'items': [{'x': 1}]}
+        >>> o = storage_view(data)
+        >>> o.a.b.c
+        1
+        >>> o.a is o.a
+        True
+        >>> o.a.b.c = 2
+        >>> o['items'][0].x = 3
+        >>> o['items'][-2]
+        Traceback (most recent call last):
+            ...
+        IndexError: list index out of range
+        >>> data
+        {'a': {'b': {'c': 2}}, 'items': [{'x': 3}]}
+        >>> o.missing
+        Traceback (most recent call last):
+            ...
+        AttributeError: 'missing'
+    """
+    __slots__ = ('_data', '_cache')
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_cache', {})
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def __getitem__(self, key):
+        return _wrap(self, key, self._data[key])
+
+    def __setitem__(self, key, value):
+        self._data[key] = _unwrap(value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._cache.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<StorageView ' + repr(self._data) + '>'
+
+
+class StorageListView(MutableSequence):
+    """list 的惰性视图，元素中的 dict/list 在访问时才包装，写入直接作用于原始 list"""
+    __slots__ = ('_data', '_cache')
+
+    def __init__(self, data):
+        self._data = data
+        self._cache = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_wrap(self, i, self._data[i]) for i in range(*index.indices(len(self._data)))]
+        value = self._data[index]  # 先用原始下标取值，越界时抛出 IndexError
+        if index < 0:
+            index += len(self._data)
+        return _wrap(self, index, value)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._data[index] = [_unwrap(v) for v in value]
+        else:
+            self._data[index] = _unwrap(value)
+
+    def __delitem__(self, index):
+        del self._data[index]
+
+    def insert(self, index, value):
+        self._data.insert(index, _unwrap(value))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<StorageListView ' + repr(self._data) + '>'
+
+
+def storage_view(data):
+    """为 dict/list 创建惰性视图（StorageView/StorageListView），其他对象原样返回"""
+    if isinstance(data, dict):
+        return StorageView(data)
+    elif isinstance(data, list):
+        return StorageListView(data)
+    return data
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
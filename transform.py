@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import datetime
-from copy import deepcopy
+import heapq
+import json
+from collections import deque
+from collections.abc import Mapping, MutableSequence
+from functools import reduce
 from numbers import Number
+from operator import itemgetter
 
 try:
-    from pymongo import ObjectId
+    from bson import ObjectId  # 随 pymongo 安装
 except ImportError:
     ObjectId = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     basestring
 except NameError:
@@ -15,47 +26,270 @@ except NameError:
 
 __all__ = [
     'obj2dict',
+    'obj2json',
+    'register_slotted',
     'dict_project',
+    'compile_projection',
     'group_by_key',
     'group_by_keys',
+    'group_aggregate',
     'merge_dicts',
     'traversal_generator',
+    'merge_by_key',
+    'async_traversal_generator',
     'check_bin',
     'update_bin',
     'filter_bin',
+    'bin_mask',
+    'match_bin',
+    'iter_bin',
+    'check_bin_array',
+    'update_bin_array',
+    'match_bin_array',
 ]
 
+_MISSING = object()
+
 
 def obj2dict(obj, datetime_format=None):
     """
-    本函数用于使对象可 json 序列化，且返回的字典都是新的（deepcopy）
+    本函数用于使对象可 json 序列化，且返回的字典/列表都是新的
+    每个类型的转换函数只解析一次并缓存；对象属性（__dict__，以及用 register_slotted 登记的类的 __slots__）
+    中以 _ 开头或全大写的会被忽略，没有 __dict__ 又未登记的对象（如 uuid.UUID）原样返回；
+    属性值不会被 deepcopy，遇到循环引用时抛出 ValueError
+    >>> @register_slotted
+    ... class Point(object):
+    ...     __slots__ = ('x', 'y', '_cache')
+    ...     def __init__(self, x, y):
+    ...         self.x, self.y = x, y
+    >>> class Shape(object):
+    ...     KIND = 'shape'
+    ...     def __init__(self, points):
+    ...         self.points = points
+    ...         self.created = datetime.date(2010, 1, 1)
+    ...         self._secret = 1
+    >>> obj2dict({'shape': Shape((Point(1, 2),))}) == {'shape': {'points': [{'x': 1, 'y': 2}], 'created': '2010-01-01'}}
+    True
+    >>> loop = []
+    >>> loop.append(loop)
+    >>> obj2dict(loop)
+    Traceback (most recent call last):
+        ...
+    ValueError: Circular reference detected
+    >>> import uuid
+    >>> obj2dict([uuid.UUID(int=5)])
+    [UUID('00000000-0000-0000-0000-000000000005')]
+    """
+    return _convert(obj, datetime_format, set())
+
+
+def register_slotted(cls):
+    """登记使用 __slots__ 的类（含子类），obj2dict/obj2json 会序列化其 slot 属性；可以用作类装饰器"""
+    _SLOTTED_TYPES.add(cls)
+    _SERIALIZERS.clear()
+    return cls
+
+
+def obj2json(obj, datetime_format=None):
     """
-    # iter collection
+    与 json.dumps(obj2dict(obj), ensure_ascii=False, separators=(',', ':')).encode('utf-8') 结果相同，
+    但直接边遍历边输出 JSON，不构造中间的字典树
+    >>> obj2json({'a': [1, 2.5, None, True], 'b': datetime.date(2010, 1, 1)})
+    b'{"a":[1,2.5,null,true],"b":"2010-01-01"}'
+    """
+    chunks = []
+    _write_json(obj, datetime_format, set(), chunks.append)
+    return ''.join(chunks).encode('utf-8')
+
+
+_ATOMIC_TYPES = frozenset([type(None), bool, int, float, str, basestring])
+_SERIALIZERS = {}
+_SLOTTED_TYPES = set()
+
+
+def _convert(obj, datetime_format, path):
+    cls = type(obj)
+    if cls in _ATOMIC_TYPES:
+        return obj
+    serializer = _SERIALIZERS.get(cls) or _compile_serializer(obj)
+    return serializer(obj, datetime_format, path)
+
+
+def _compile_serializer(obj):
+    """按 obj2dict 原有的判断顺序，为 type(obj) 选出转换函数并缓存"""
+    cls = type(obj)
     if isinstance(obj, dict):
-        return {obj2dict(k, datetime_format): obj2dict(v, datetime_format) for k, v in obj.items()}
+        serializer = _serialize_dict
     elif isinstance(obj, (list, tuple)):
-        return [obj2dict(m, datetime_format) for m in obj]
-    # json seriable
+        serializer = _serialize_list
+    elif isinstance(obj, Mapping):  # Record、StorageView 等
+        serializer = _serialize_dict
+    elif isinstance(obj, MutableSequence):  # StorageListView 等
+        serializer = _serialize_list
     elif isinstance(obj, datetime.datetime):
-        return obj.strftime(datetime_format) if datetime_format else obj.isoformat(' ')
-    elif isinstance(obj, datetime.date):
-        return obj.strftime(datetime_format) if datetime_format else obj.isoformat()
-    elif isinstance(obj, datetime.time):
-        return obj.strftime(datetime_format) if datetime_format else obj.isoformat()
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    # object -> dict
-    elif hasattr(obj, '__dict__') and not isinstance(obj, Number):
-        obj_json = deepcopy(obj.__dict__)
-        to_pop = []
-        for k in obj_json:
-            if isinstance(k, basestring) and (k.startswith('_') or k.isupper()):
-                to_pop.append(k)
-        for k in to_pop:
-            obj_json.pop(k)
-        return obj2dict(obj_json, datetime_format)
+        serializer = _serialize_datetime
+    elif isinstance(obj, (datetime.date, datetime.time)):
+        serializer = _serialize_date
+    elif ObjectId is not None and isinstance(obj, ObjectId):
+        serializer = _serialize_str
+    elif isinstance(obj, Number) or not (hasattr(obj, '__dict__') or _is_slotted(cls)):
+        serializer = _serialize_identity
     else:
-        return obj
+        serializer = _object_serializer(cls)
+    _SERIALIZERS[cls] = serializer
+    return serializer
+
+
+def _enter(obj, path):
+    key = id(obj)
+    if key in path:
+        raise ValueError('Circular reference detected')
+    path.add(key)
+    return key
+
+
+def _serialize_dict(obj, datetime_format, path):
+    key = _enter(obj, path)
+    try:
+        return {_convert(k, datetime_format, path): _convert(v, datetime_format, path) for k, v in obj.items()}
+    finally:
+        path.discard(key)
+
+
+def _serialize_list(obj, datetime_format, path):
+    key = _enter(obj, path)
+    try:
+        return [_convert(m, datetime_format, path) for m in obj]
+    finally:
+        path.discard(key)
+
+
+def _serialize_datetime(obj, datetime_format, path):
+    return obj.strftime(datetime_format) if datetime_format else obj.isoformat(' ')
+
+
+def _serialize_date(obj, datetime_format, path):
+    return obj.strftime(datetime_format) if datetime_format else obj.isoformat()
+
+
+def _serialize_str(obj, datetime_format, path):
+    return str(obj)
+
+
+def _serialize_identity(obj, datetime_format, path):
+    return obj
+
+
+def _is_public_attr(k):
+    return not (isinstance(k, basestring) and (k.startswith('_') or k.isupper()))
+
+
+def _is_slotted(cls):
+    return any(klass in _SLOTTED_TYPES for klass in cls.__mro__)
+
+
+def _slot_names(cls):
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        for name in ((slots,) if isinstance(slots, basestring) else slots):
+            if name not in ('__dict__', '__weakref__') and name not in names:
+                names.append(name)
+    return names
+
+
+def _object_serializer(cls):
+    slots = [name for name in _slot_names(cls) if _is_public_attr(name)] if _is_slotted(cls) else []
+    public = {}  # __dict__ 中各属性名是否保留，每个类只判断一次
+
+    def attr_items(obj):
+        for k, v in getattr(obj, '__dict__', {}).items():
+            keep = public.get(k)
+            if keep is None:
+                keep = public[k] = _is_public_attr(k)
+            if keep:
+                yield k, v
+        for name in slots:
+            try:
+                yield name, getattr(obj, name)
+            except AttributeError:  # 未赋值的 slot
+                pass
+
+    def serializer(obj, datetime_format, path):
+        key = _enter(obj, path)
+        try:
+            return {_convert(k, datetime_format, path): _convert(v, datetime_format, path)
+                    for k, v in attr_items(obj)}
+        finally:
+            path.discard(key)
+
+    serializer.attr_items = attr_items
+    return serializer
+
+
+def _encode_float(obj):
+    if obj != obj:
+        return 'NaN'
+    elif obj in (float('inf'), float('-inf')):
+        return 'Infinity' if obj > 0 else '-Infinity'
+    return float.__repr__(obj)
+
+
+_JSON_ENCODERS = {
+    type(None): lambda obj: 'null',
+    bool: lambda obj: 'true' if obj else 'false',
+    int: int.__repr__,
+    float: _encode_float,
+    str: json.encoder.encode_basestring,
+}
+
+
+def _json_key(key):
+    cls = type(key)
+    if cls is str or cls is basestring:
+        return json.encoder.encode_basestring(key)
+    elif cls in _JSON_ENCODERS:
+        return '"%s"' % _JSON_ENCODERS[cls](key)
+    raise TypeError('keys must be str, int, float, bool or None, not %s' % cls.__name__)
+
+
+def _write_json(obj, datetime_format, path, write):
+    cls = type(obj)
+    encoder = _JSON_ENCODERS.get(cls)
+    if encoder is not None:
+        write(encoder(obj))
+        return
+    serializer = _SERIALIZERS.get(cls) or _compile_serializer(obj)
+    if serializer is _serialize_dict or serializer is _serialize_list or hasattr(serializer, 'attr_items'):
+        key = _enter(obj, path)
+        try:
+            if serializer is _serialize_list:
+                write('[')
+                for i, m in enumerate(obj):
+                    if i:
+                        write(',')
+                    _write_json(m, datetime_format, path, write)
+                write(']')
+            else:
+                items = obj.items() if serializer is _serialize_dict else serializer.attr_items(obj)
+                write('{')
+                for i, (k, v) in enumerate(items):
+                    if i:
+                        write(',')
+                    write(_json_key(_convert(k, datetime_format, path)))
+                    write(':')
+                    _write_json(v, datetime_format, path, write)
+                write('}')
+        finally:
+            path.discard(key)
+        return
+    value = serializer(obj, datetime_format, path)
+    encoder = _JSON_ENCODERS.get(type(value))
+    write(encoder(value) if encoder is not None else json.dumps(value, ensure_ascii=False))
+
+
+_PROJECTIONS = {}  # dict_project 的规则 => Projection
+_PROJECTION_CACHE_SIZE = 256
 
 
 def dict_project(data, map_rules={}):
@@ -76,14 +310,115 @@ def dict_project(data, map_rules={}):
     ... }
     >>> dict_project(data, map_rules)
     {'c': 'value of c'}
+
+    data 为 list/tuple 时返回 list，为其他可迭代对象（如 generator、数据库游标）时返回惰性的 generator
+    data 也可以是 Storage、structure.record_type 生成的记录等其他 Mapping
     """
-    if isinstance(data, dict):
-        data = {map_rules[k] if isinstance(map_rules[k], basestring) else k: data[k] for k in data if k in map_rules}
+    if isinstance(data, dict):  # 最常见的单个 dict 直接投影，不编译规则
+        projected = {}
+        for k, rule in map_rules.items():
+            if k in data:
+                projected[rule if isinstance(rule, basestring) else k] = data[k]
+            elif isinstance(k, basestring) and '.' in k:  # 嵌套路径交给 Projection
+                return compile_projection(map_rules)(data)
+        return projected
+    try:  # 同一组规则只编译一次
+        cache_key = tuple(map_rules.items())
+        projection = _PROJECTIONS.get(cache_key)
+    except TypeError:  # 规则中有不可哈希的值
+        cache_key = projection = None
+    if projection is None:
+        projection = compile_projection(map_rules)
+        if cache_key is not None:
+            if len(_PROJECTIONS) >= _PROJECTION_CACHE_SIZE:
+                _PROJECTIONS.clear()
+            _PROJECTIONS[cache_key] = projection
+    if isinstance(data, Mapping):
+        return projection(data)
     elif isinstance(data, (list, tuple)):
-        return [dict_project(o, map_rules) for o in data]
+        return projection._project_list(data)
+    elif hasattr(data, '__iter__') and not isinstance(data, basestring):
+        return projection.many(data)
     else:
         raise ValueError('无法处理对象: %s' % str(data))
-    return data
+
+
+class Projection(object):
+    """
+    由 compile_projection 生成的投影函数，改名规则只在编译时解析一次
+    >>> project = compile_projection({'a': 'x', 'b.c': 'y', 'd': 1}, defaults={'d': 0})
+    >>> project({'a': 1, 'b': {'c': 2}}) == {'x': 1, 'y': 2, 'd': 0}
+    True
+    >>> list(project.many(iter([{'a': 1}, {'d': 4}])))
+    [{'x': 1, 'd': 0}, {'d': 4}]
+    """
+
+    def __init__(self, map_rules, defaults=None):
+        defaults = defaults or {}
+        self._rules = []  # (源键, 按 . 拆分的路径或 None, 输出键, 默认值)
+        for k, rule in map_rules.items():
+            out = rule if isinstance(rule, basestring) else k
+            path = k.split('.') if isinstance(k, basestring) and '.' in k else None
+            self._rules.append((k, path, out, defaults.get(k, _MISSING)))
+        self._simple = all(path is None and default is _MISSING for _, path, _, default in self._rules)
+        self._keys = tuple(k for k, _, _, _ in self._rules)
+        self._outs = tuple(out for _, _, out, _ in self._rules)
+        self._pairs = tuple(zip(self._keys, self._outs))
+        if self._simple and self._keys:
+            getter = itemgetter(*self._keys)
+            self._getter = getter if len(self._keys) > 1 else lambda record: (getter(record),)
+
+    def __call__(self, record):
+        if self._simple:
+            if not self._keys:
+                return {}
+            try:  # 常见情况下所有键都存在，一次 itemgetter 取完
+                return dict(zip(self._outs, self._getter(record)))
+            except KeyError:
+                return {out: record[k] for k, out in zip(self._keys, self._outs) if k in record}
+        projected = {}
+        for k, path, out, default in self._rules:
+            if k in record:
+                projected[out] = record[k]
+            elif path is not None:
+                value = record
+                for part in path:
+                    if isinstance(value, (dict, Mapping)) and part in value:
+                        value = value[part]
+                    else:
+                        value = _MISSING
+                        break
+                if value is not _MISSING:
+                    projected[out] = value
+                elif default is not _MISSING:
+                    projected[out] = default
+            elif default is not _MISSING:
+                projected[out] = default
+        return projected
+
+    def _project_list(self, records):
+        """结果同 [self(r) for r in records]，简单规则时内联投影，省去逐条的函数调用"""
+        if not self._simple:
+            return [self(record) for record in records]
+        if len(self._pairs) == 1:
+            (k, out), = self._pairs
+            return [{out: record[k]} if k in record else {} for record in records]
+        pairs = self._pairs
+        return [{out: record[k] for k, out in pairs if k in record} for record in records]
+
+    def many(self, records):
+        """对可迭代对象惰性投影，内存占用不随记录数增长"""
+        for record in records:
+            yield self(record)
+
+
+def compile_projection(map_rules, defaults=None):
+    """
+    预编译 dict_project 的 map_rules，返回可重复调用的 Projection
+    map_rules 的键可以是 'a.b.c' 形式的嵌套路径（记录中存在同名的键时优先取该键），
+    defaults 为 {map_rules 的键: 默认值}，键缺失时使用默认值，否则不输出该键
+    """
+    return Projection(map_rules, defaults)
 
 
 def group_by_key(dict_list, key):
@@ -120,39 +455,241 @@ def group_by_keys(dict_list, keys):
     return groups
 
 
-def merge_dicts(dicts):
+def group_aggregate(rows, keys, aggregations):
+    """
+    分组聚合，只遍历一次 rows，内存占用只与分组数有关，适合代替 group_by_key/group_by_keys 之后再统计的写法
+    rows: dict 的可迭代对象（可以是 generator），或 {列名: 序列} 形式的列式数据（列为 NumPy 数组时走向量化计算）
+    keys: 单个键名时分组键为该值，键名列表时分组键为 tuple，缺失的键视为 None
+    aggregations: {输出名: 聚合}，聚合可以是 'count'，或 (操作, 字段)，
+        操作为 'count'/'sum'/'min'/'max'/'first'/'last'，或自定义的 func(acc, value)（以第一个值为初始 acc）
+        sum/min/max/自定义会跳过值为 None 或缺失的字段，没有任何值时 min/max/自定义的结果为 None
+    >>> data = [
+    ...     {'a': 1, 'b': 2},
+    ...     {'a': 1, 'b': 3},
+    ...     {'a': 2, 'b': 5},
+    ... ]
+    >>> result = group_aggregate(data, 'a', {'n': 'count', 'total': ('sum', 'b'), 'top': ('max', 'b')})
+    >>> result == {1: {'n': 2, 'total': 5, 'top': 3}, 2: {'n': 1, 'total': 5, 'top': 5}}
+    True
+    >>> group_aggregate(data, ['a'], {'bs': (lambda acc, v: acc * v, 'b')})
+    {(1,): {'bs': 6}, (2,): {'bs': 5}}
+
+    列式数据为 list 时逐行计算，为 NumPy 数组时向量化计算，两者结果相同
+    >>> columns = {'k': ['A', 'B', 'B'], 'v': [10, 1, 2]}
+    >>> aggs = {'lo': ('min', 'v'), 'hi': ('max', 'v'), 'prod': (lambda acc, v: acc * v, 'v')}
+    >>> expected = group_aggregate(columns, 'k', aggs)
+    >>> expected == {'A': {'lo': 10, 'hi': 10, 'prod': 10}, 'B': {'lo': 1, 'hi': 2, 'prod': 2}}
+    True
+    >>> numpy is None or group_aggregate({'k': numpy.array(columns['k']), 'v': numpy.array(columns['v'])},
+    ...                                  'k', aggs) == expected
+    True
+    >>> numpy is None or group_aggregate({'k': numpy.array(columns['k']), 'v': columns['v']},
+    ...                                  'k', {'prod': (lambda acc, v: acc * v, 'v')}) == {'A': {'prod': 10}, 'B': {'prod': 2}}
+    True
+    """
+    single = isinstance(keys, basestring)
+    key_names = [keys] if single else list(keys)
+    specs = [(name, ) + _aggregation_spec(agg) for name, agg in aggregations.items()]
+    if isinstance(rows, dict):
+        if numpy is not None and all(isinstance(rows[k], numpy.ndarray) for k in key_names) and \
+                all(callable(op) or field is None or isinstance(rows[field], numpy.ndarray) for _, op, field in specs):
+            return _group_aggregate_numpy(rows, key_names, single, specs)
+        columns = list(rows)
+        rows = (dict(zip(columns, values)) for values in zip(*[rows[c] for c in columns]))
+    initial = [0 if op in ('count', 'sum') else _MISSING for _, op, _ in specs]
+    updaters = [(i, _AGGREGATORS.get(op, op), field, op == 'count') for i, (_, op, field) in enumerate(specs)]
+    groups = {}
+    for row in rows:
+        group_key = row.get(keys) if single else tuple(row.get(k) for k in key_names)
+        state = groups.get(group_key)
+        if state is None:
+            state = groups[group_key] = list(initial)
+        for i, update, field, is_count in updaters:
+            if is_count:
+                state[i] += 1
+                continue
+            value = row.get(field)
+            if value is None and update is not _last and update is not _first:
+                continue
+            acc = state[i]
+            state[i] = value if acc is _MISSING else update(acc, value)
+    names = [name for name, _, _ in specs]
+    return {group_key: {name: (None if v is _MISSING else v) for name, v in zip(names, state)}
+            for group_key, state in groups.items()}
+
+
+def _first(acc, value):
+    return acc
+
+
+def _last(acc, value):
+    return value
+
+
+_AGGREGATORS = {
+    'sum': lambda acc, value: acc + value,
+    'min': min,
+    'max': max,
+    'first': _first,
+    'last': _last,
+}
+
+
+def _aggregation_spec(agg):
+    if agg == 'count':
+        return 'count', None
+    op, field = agg
+    if not callable(op) and op not in _AGGREGATORS and op != 'count':
+        raise ValueError('Unsupported aggregation: %s' % op)
+    return op, field
+
+
+def _group_aggregate_numpy(columns, key_names, single, specs):
+    codes, uniques = None, []
+    for k in key_names:
+        unique, inverse = numpy.unique(columns[k], return_inverse=True)
+        uniques.append(unique.tolist())
+        codes = inverse if codes is None else codes * len(unique) + inverse
+    group_codes, inverse = numpy.unique(codes, return_inverse=True)
+    n = len(group_codes)
+    # 由组合编码还原各列的取值
+    parts, rest = [], group_codes
+    for unique in reversed(uniques):
+        parts.append(rest % len(unique))
+        rest = rest // len(unique)
+    parts.reverse()
+    group_keys = [uniques[0][i] for i in parts[0].tolist()] if single else \
+        list(zip(*[[unique[i] for i in part.tolist()] for unique, part in zip(uniques, parts)]))
+    counts = numpy.bincount(inverse, minlength=n)
+    results = {}
+    for name, op, field in specs:
+        if op == 'count':
+            results[name] = counts.tolist()
+        elif callable(op):  # 自定义聚合只能逐组归约
+            values = numpy.asarray(columns[field])
+            order = numpy.argsort(inverse, kind='stable')
+            bounds = numpy.cumsum(counts)[:-1]
+            results[name] = [reduce(op, chunk.tolist()) if len(chunk) else None
+                             for chunk in numpy.split(values[order], bounds)]
+        else:
+            values = columns[field]
+            if op == 'sum':
+                out = numpy.zeros(n, dtype=values.dtype)
+                numpy.add.at(out, inverse, values)
+            elif op in ('min', 'max'):
+                first = numpy.full(n, len(values))
+                numpy.minimum.at(first, inverse, numpy.arange(len(values)))
+                out = values[first]  # 以各组的第一个值为初值
+                (numpy.minimum if op == 'min' else numpy.maximum).at(out, inverse, values)
+            else:
+                index = numpy.full(n, len(values) if op == 'first' else -1)
+                (numpy.minimum if op == 'first' else numpy.maximum).at(index, inverse, numpy.arange(len(values)))
+                out = values[index]
+            results[name] = out.tolist()
+    return {group_key: {name: results[name][i] for name, _, _ in specs} for i, group_key in enumerate(group_keys)}
+
+
+def merge_dicts(dicts, resolver=None, recursive=False):
     """将一组 dicts 取并集返回，键值冲突处理规则为：
     1. 优先返回最大的数值
     2. 若无数值类型，则返回倒数第一个值
+    dicts 可以是任意可迭代对象（如 generator），只遍历一次，每个键只保留当前胜出的值
+    resolver(current, new) 可以替换上述规则，返回冲突时保留的值，也可以是 {key: resolver}，未列出的键用默认规则
+    recursive=True 时，两个值都是 dict 则递归合并（不修改传入的 dict）
+    >>> merge_dicts([{'a': 1, 'b': 'x'}, {'a': 3, 'b': 'y'}, {'a': 'z', 'c': 0}]) == {'a': 3, 'b': 'y', 'c': 0}
+    True
+    >>> import operator
+    >>> merge_dicts(iter([{'hits': 1}, {'hits': 2}]), resolver=operator.add)
+    {'hits': 3}
+    >>> merge_dicts([{'s': {'a': 1, 'b': 5}}, {'s': {'a': 2}}], recursive=True)
+    {'s': {'a': 2, 'b': 5}}
     """
-    total_k = reduce(lambda x, y: x | y.keys(), dicts, {})
-    _d = {}
-    for k in total_k:
-        total_v = [d[k] for d in dicts if k in d]  # 必不为空
-        # 选出最合适的一个
-        numbers_v = [v for v in total_v if isinstance(v, Number)]
-        if numbers_v:
-            _d[k] = max(numbers_v)
+    resolvers = resolver if isinstance(resolver, dict) else {}
+    default = (resolver if callable(resolver) else None) or _max_number_or_last
+    merged = {}
+    owned = set()  # 合并过程中新建的 dict，可以原地修改
+    for d in dicts:
+        for k, v in d.items():
+            if k not in merged:
+                merged[k] = v
+                continue
+            current = merged[k]
+            if recursive and isinstance(current, dict) and isinstance(v, dict):
+                merged[k] = _merge_nested(current, v, owned, resolvers.get(k, default))
+            else:
+                merged[k] = resolvers.get(k, default)(current, v)
+    return merged
+
+
+def _max_number_or_last(current, new):
+    if isinstance(new, Number):
+        return max(current, new) if isinstance(current, Number) else new
+    return current if isinstance(current, Number) else new
+
+
+def _merge_nested(current, new, owned, resolver):
+    if id(current) not in owned:
+        current = dict(current)
+        owned.add(id(current))
+    for k, v in new.items():
+        if k not in current:
+            current[k] = v
+        elif isinstance(current[k], dict) and isinstance(v, dict):
+            current[k] = _merge_nested(current[k], v, owned, resolver)
         else:
-            _d[k] = total_v[-1]
-    return _d
+            current[k] = resolver(current[k], v)
+    return current
 
 
 def traversal_generator(*iterables):
     """
     通过返回一个 generator, 可以从 n 个 iterables 中轮流取元素，保证取完
+    取完的 iterable 会被立即移出轮转队列，之后不再访问
+    >>> list(traversal_generator([1, 2, 3], 'a', (None, None)))
+    [1, 'a', None, 2, None, 3]
     """
-    iterables = [i if hasattr(i, 'next') else iter(i) for i in iterables]
-    done = False
-    while not done:
-        done = True
-        for i in range(len(iterables)):
-            try:
-                yield next(iterables[i])
-                done = False
-            except StopIteration:
-                pass
-    return
+    pending = deque(iter(i) for i in iterables)
+    while pending:
+        iterator = pending.popleft()
+        for item in iterator:  # 只取一个元素；取不到说明已耗尽，不再放回队列
+            yield item
+            pending.append(iterator)
+            break
+
+
+def merge_by_key(*iterables, key=None, reverse=False):
+    """
+    把若干个已经按 key 排好序的 iterables 用堆做 k 路归并，返回一个有序的 generator，
+    例如把多个日志扫描器的输出按时间合并
+    key: 排序键函数，默认为元素本身；reverse=True 时各输入应为降序
+    >>> list(merge_by_key([1, 4, 7], [2, 5], [3, 6, 9]))
+    [1, 2, 3, 4, 5, 6, 7, 9]
+    >>> list(merge_by_key([('a', 3)], [('b', 1), ('c', 5)], key=lambda x: x[1]))
+    [('b', 1), ('a', 3), ('c', 5)]
+    """
+    return heapq.merge(*iterables, key=key, reverse=reverse)
+
+
+async def async_traversal_generator(*aiterables):
+    """
+    traversal_generator 的 asyncio 版本：同时等待所有异步可迭代对象，谁先产出就先返回谁的元素
+    """
+    iterators = [i.__aiter__() for i in aiterables]
+    pending = {asyncio.ensure_future(it.__anext__()): it for it in iterators}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                iterator = pending.pop(future)
+                try:
+                    item = future.result()
+                except StopAsyncIteration:
+                    continue
+                pending[asyncio.ensure_future(iterator.__anext__())] = iterator
+                yield item
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 def check_bin(number, index):
@@ -164,10 +701,7 @@ def check_bin(number, index):
     >>> check_bin(2, 2)
     1
     """
-    try:
-        return int(bin(number)[2:][-index])
-    except IndexError:
-        return 0
+    return (number >> (index - 1)) & 1
 
 
 def update_bin(number, index_pairs):
@@ -178,13 +712,57 @@ def update_bin(number, index_pairs):
     0
     >>> update_bin(2, {3: 1})
     6
+    >>> update_bin(7, {2: 0})
+    5
     """
-    for index, value in index_pairs.items():
-        if value:
-            number = number | int('1' + '0' * (index - 1), 2)
-        else:
-            number = number & int('0' + '1' * (index - 1), 2)
-    return number
+    mask, value = bin_mask(index_pairs)
+    return (number & ~mask) | value
+
+
+def bin_mask(index_pairs):
+    """
+    用于某些二进制标志位的场景
+    把 {index: value} 转换为 (mask, value)，number 满足条件当且仅当 number & mask == value
+    >>> bin_mask({1: 1, 3: 0})
+    (5, 1)
+    """
+    mask = value = 0
+    for index, bit in index_pairs.items():
+        mask |= 1 << (index - 1)
+        if bit:
+            value |= 1 << (index - 1)
+    return mask, value
+
+
+def match_bin(number, index_pairs):
+    """
+    用于某些二进制标志位的场景
+    判断 number 的第 index 位是否都为 value
+    >>> match_bin(5, {1: 1, 2: 0})
+    True
+    """
+    mask, value = bin_mask(index_pairs)
+    return number & mask == value
+
+
+def iter_bin(length, index_pairs):
+    """
+    用于某些二进制标志位的场景
+    filter_bin 的 generator 版本，按从小到大的顺序直接枚举其余的自由位，而不是检查全部 2^length 个数
+    >>> list(iter_bin(3, {1: 0, 2: 1}))
+    [2, 6]
+    """
+    mask, value = bin_mask(index_pairs)
+    full = (1 << length) - 1
+    if value & ~full:  # 要求为 1 的位超出了 length
+        return
+    free = full & ~mask
+    subset = 0
+    while True:  # 按升序枚举 free 的所有子集
+        yield value | subset
+        subset = (subset - free) & free
+        if not subset:
+            return
 
 
 def filter_bin(length, index_pairs):
@@ -199,19 +777,32 @@ def filter_bin(length, index_pairs):
     >>> filter_bin(3, {1: 0, 2: 1})
     [2, 6]
     """
-    ret = []
-    for number in range(int('1' * length, 2) + 1):
-        match = True
-        for index in index_pairs:
-            if len(bin(number)) - index >= 2:  # 位数够
-                if int(bin(number)[-index]) ^ index_pairs[index]:
-                    match = False
-            else:  # 位数不够
-                if index_pairs[index]:
-                    match = False
-        if match:
-            ret.append(number)
-    return ret
+    return list(iter_bin(length, index_pairs))
+
+
+def _as_array(numbers, func_name):
+    if numpy is None:
+        raise ImportError('%s requires NumPy' % func_name)
+    return numpy.asarray(numbers)
+
+
+def check_bin_array(numbers, index):
+    """check_bin 的 NumPy 向量化版本，返回每个数第 index 位的值组成的数组"""
+    return (_as_array(numbers, 'check_bin_array') >> (index - 1)) & 1
+
+
+def update_bin_array(numbers, index_pairs):
+    """update_bin 的 NumPy 向量化版本，返回新数组"""
+    numbers = _as_array(numbers, 'update_bin_array')
+    mask, value = bin_mask(index_pairs)
+    return (numbers & ~numpy.asarray(mask, dtype=numbers.dtype)) | numpy.asarray(value, dtype=numbers.dtype)
+
+
+def match_bin_array(numbers, index_pairs):
+    """match_bin 的 NumPy 向量化版本，返回 bool 数组，可直接用于筛选记录"""
+    numbers = _as_array(numbers, 'match_bin_array')
+    mask, value = bin_mask(index_pairs)
+    return (numbers & numpy.asarray(mask, dtype=numbers.dtype)) == value
 
 
 if __name__ == '__main__':